@@ -0,0 +1,53 @@
+from collections import namedtuple
+import numpy as np
+from game import *
+
+# Features of a stack of frozen boards, each field having the leading shape of the boards passed in.
+#   aggregate_height    -- sum of the column heights
+#   column_heights      -- height of every column, 0 for an empty column
+#   holes               -- empty cells below the top block of their column
+#   bumpiness           -- sum of the absolute height differences between neighbouring columns
+#   row_transitions     -- filled/empty changes along the rows, the side walls counting as filled
+#   column_transitions  -- filled/empty changes along the columns, the floor counting as filled
+#   well_depths         -- per column, how far it sits below both neighbours, the side walls counting as full height
+#   completed_lines     -- rows that are completely filled
+BoardFeatures = namedtuple('BoardFeatures', ('aggregate_height', 'column_heights', 'holes', 'bumpiness',
+                                             'row_transitions', 'column_transitions', 'well_depths',
+                                             'completed_lines'))
+
+
+def compute_board_features(boards: np.ndarray) -> BoardFeatures:
+    # Takes a single (rows, columns) board, such as GameState.frozen_blocks, or any stack of them, such as
+    # VecGame.frozen_blocks or Placements.boards.
+    leading_shape = boards.shape[:-2]
+    rows, columns = boards.shape[-2:]
+    filled = (boards != 0).reshape((-1, rows, columns))
+
+    column_heights = compute_column_heights(filled)
+    aggregate_height = column_heights.sum(axis=1)
+    holes = aggregate_height - filled.sum(axis=(1, 2))
+    bumpiness = np.abs(np.diff(column_heights, axis=1)).sum(axis=1)
+
+    walled = np.pad(filled, ((0, 0), (0, 0), (1, 1)), constant_values=True)
+    row_transitions = (walled[:, :, 1:] != walled[:, :, :-1]).sum(axis=(1, 2))
+    floored = np.pad(filled, ((0, 0), (0, 1), (0, 0)), constant_values=True)
+    column_transitions = (floored[:, 1:] != floored[:, :-1]).sum(axis=(1, 2))
+
+    walled_heights = np.pad(column_heights, ((0, 0), (1, 1)), constant_values=rows)
+    neighbour_heights = np.minimum(walled_heights[:, :-2], walled_heights[:, 2:])
+    well_depths = np.maximum(neighbour_heights - column_heights, 0)
+
+    completed_lines = filled.all(axis=2).sum(axis=1)
+
+    return BoardFeatures(*(feature.reshape(leading_shape + feature.shape[1:]) for feature in (
+        aggregate_height, column_heights, holes, bumpiness, row_transitions, column_transitions, well_depths,
+        completed_lines)))
+
+
+if __name__ == "__main__":
+    state = new_game()
+    for _ in range(20):
+        user_drop_piece(state)
+        step(state)
+    print(state.frozen_blocks)
+    print(compute_board_features(state.frozen_blocks))
@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import os
+import torch
+
+
+def save_atomically(obj, filepath):
+    # Writes to a temporary file first and renames it over filepath, so that readers never see a partial file.
+    temporary_filepath = filepath + '.tmp'
+    with open(temporary_filepath, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_filepath, filepath)
+
+
+def snapshot_state_dict(state_dict):
+    # Detached CPU copy of a module's state_dict, safe to write out while training goes on.
+    return {key: value.detach().cpu().clone() for key, value in state_dict.items()}
+
+
+# Writes training checkpoints in directory on a background thread, keeping the `keep` most recent ones.
+# save() takes a state that has already been copied off the live objects, so training can go on while it is
+# written; a save waits for the previous one to finish, so at most one state is held for writing at a time.
+class Checkpointer:
+    FILENAME_FORMAT = 'checkpoint-{:08d}.pth'
+
+    def __init__(self, directory, keep=3):
+        self.directory = directory
+        self.keep = keep
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        os.makedirs(directory, exist_ok=True)
+
+    def checkpoints(self):
+        return sorted(glob.glob(os.path.join(self.directory, self.FILENAME_FORMAT.replace('{:08d}', '*'))))
+
+    def save(self, step, state, extra_files=()):
+        # extra_files are (obj, filepath) pairs written atomically along with the checkpoint.
+        self.wait()
+        self.future = self.executor.submit(self.write, step, state, extra_files)
+
+    def write(self, step, state, extra_files):
+        save_atomically(state, os.path.join(self.directory, self.FILENAME_FORMAT.format(step)))
+        for obj, filepath in extra_files:
+            save_atomically(obj, filepath)
+        for filepath in self.checkpoints()[:-self.keep]:
+            os.remove(filepath)
+
+    def wait(self):
+        # Blocks until the last save is written, raising its error if it failed.
+        if self.future is not None:
+            self.future.result()
+            self.future = None
+
+    def load_latest(self, map_location=None):
+        checkpoints = self.checkpoints()
+        if not checkpoints:
+            return None
+        return torch.load(checkpoints[-1], map_location=map_location, weights_only=False)
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
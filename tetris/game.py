@@ -1,12 +1,26 @@
 import numpy as np
+from collections import namedtuple
 from enum import Enum
 from game_piece import *
-import copy
+from zobrist import *
+import struct
+import sys
 
-GAME_ROWS = 20
-GAME_COLS = 10
 GAME_ACTIONS = 5
 
+# Scores for removing 0, 1, 2, 3 or 4 lines at once, as in score_removed_lines.
+REMOVED_LINES_SCORES = np.array([0, 100, 300, 500, 800])
+
+# Column at which new pieces are staged.
+SPAWN_COL = (GAME_COLS - SHAPE_BOX_SIZE) // 2
+
+# Final afterstates of every distinct placement of a piece, aligned along the first axis. `actions` are the
+# rotation x column macro actions of train_basic_conv2d_v2 that lead to each placement. Placements are taken
+# to be reachable from straight above the skyline; near the top of a tall stack the key presses simulated by
+# perform_action may be blocked on their way there.
+Placements = namedtuple('Placements', ('actions', 'rotations', 'columns', 'rows', 'boards',
+                                       'lines_cleared', 'score_deltas'))
+
 
 class GameStatus(Enum):
     RUNNING = 1
@@ -19,7 +33,27 @@ class GameState:
     DATA_INDEX_FALLING_BLOCKS = 2
     DATA_INDEX_FALLING_BLOCKS_COLOR_CODE = 3
 
-    def __init__(self, rows, columns):
+    STATISTICS = ('score', 'op_left', 'op_right', 'op_rotate', 'op_soft_drop', 'op_hard_drop',
+                  'single_line_cleared', 'double_lines_cleared', 'triple_lines_cleared', 'tetris_line_cleared',
+                  'soft_drop_distance', 'hard_drop_distance')
+
+    # Planes only ever hold 0/1 blocks and color codes below 10.
+    DATA_DTYPE = np.uint8
+
+    # Snapshot layout: this header, then the frozen blocks bit-packed, then the frozen color codes as uint8.
+    # The header holds the status, falling piece id and rotation, next piece id and rotation,
+    # falling piece location, the statistics above and the PieceGenerator state: its 128-bit entropy, mode,
+    # block size, block index and position.
+    SNAPSHOT_HEADER = struct.Struct('<5B2h{}i16sBIqI'.format(len(STATISTICS)))
+
+    # The falling and next pieces are stored as (piece_id, rotation) and exposed as the shared Piece instances
+    # through the falling_piece and next_falling_piece properties.
+    __slots__ = ('rows', 'columns', 'status') + STATISTICS + (
+        '_data', 'falling_blocks_dirty', 'falling_piece_id', 'falling_piece_rotation', 'falling_piece_location',
+        'next_piece_id', 'next_piece_rotation', 'column_heights', 'row_fill_counts', 'locked_rows',
+        'board_hash', 'piece_generator')
+
+    def __init__(self, rows, columns, piece_generator=None):
         self.rows = rows
         self.columns = columns
         self.status = GameStatus.RUNNING
@@ -35,10 +69,18 @@ class GameState:
         self.tetris_line_cleared = 0  # i.e. quadruple lines cleared
         self.soft_drop_distance = 0
         self.hard_drop_distance = 0
-        self.data = np.zeros((4, rows, columns), dtype=np.int)
+        # The falling planes of _data are only repainted when read through `data` or the falling_* properties,
+        # engine functions flag them dirty instead of repainting on every move.
+        self._data = np.zeros((4, rows, columns), dtype=self.DATA_DTYPE)
+        self.falling_blocks_dirty = False
         self.falling_piece = PIECE_NONE
-        self.falling_piece_location = np.zeros(2, dtype=np.int)
+        self.falling_piece_location = [0, 0]
         self.next_falling_piece = PIECE_NONE
+        self.column_heights = np.zeros(columns, dtype=int)  # skyline of frozen_blocks, 0 for an empty column
+        self.row_fill_counts = np.zeros(rows, dtype=int)  # number of frozen blocks in each row
+        self.locked_rows = None  # (first, last + 1) rows touched by the last frozen piece, None for all rows
+        self.board_hash = 0  # Zobrist hash of frozen_blocks
+        self.piece_generator = piece_generator if piece_generator is not None else PieceGenerator()
 
     def __str__(self):
         block_statistics = 'block_count: {}\tblock_fill_rate: {}\n'.format(self.block_count, self.block_fill_rate)
@@ -55,6 +97,104 @@ class GameState:
             self.soft_drop_distance, self.hard_drop_distance)
         return block_statistics + op_statistics + line_statistics + distance_statistics
 
+    def clone(self):
+        state = object.__new__(type(self))
+        state.rows = self.rows
+        state.columns = self.columns
+        state.status = self.status
+        for name in self.STATISTICS:
+            setattr(state, name, getattr(self, name))
+        state._data = self._data.copy()
+        state.falling_blocks_dirty = self.falling_blocks_dirty
+        state.falling_piece_id = self.falling_piece_id
+        state.falling_piece_rotation = self.falling_piece_rotation
+        state.falling_piece_location = self.falling_piece_location.copy()
+        state.next_piece_id = self.next_piece_id
+        state.next_piece_rotation = self.next_piece_rotation
+        state.column_heights = self.column_heights.copy()
+        state.row_fill_counts = self.row_fill_counts.copy()
+        state.locked_rows = self.locked_rows
+        state.board_hash = self.board_hash
+        state.piece_generator = self.piece_generator.clone()
+        return state
+
+    def snapshot(self) -> bytes:
+        entropy, mode, block_size, block_index, position = self.piece_generator.get_state()
+        header = self.SNAPSHOT_HEADER.pack(
+            self.status.value,
+            self.falling_piece_id, self.falling_piece_rotation,
+            self.next_piece_id, self.next_piece_rotation,
+            *self.falling_piece_location,
+            *(getattr(self, name) for name in self.STATISTICS),
+            entropy.to_bytes(16, 'little'), PieceGenerator.MODES.index(mode), block_size, block_index, position)
+        frozen_blocks = np.packbits(self.frozen_blocks != 0)
+        frozen_blocks_color_code = self.frozen_blocks_color_code.astype(np.uint8)
+        return b''.join((header, frozen_blocks.tobytes(), frozen_blocks_color_code.tobytes()))
+
+    def restore(self, snapshot: bytes):
+        header = self.SNAPSHOT_HEADER.unpack_from(snapshot)
+        status, falling_piece_id, falling_rotation, next_piece_id, next_rotation, row, col = header[:7]
+        self.status = GameStatus(status)
+        statistics_end = 7 + len(self.STATISTICS)
+        for name, value in zip(self.STATISTICS, header[7:statistics_end]):
+            setattr(self, name, value)
+        entropy, mode, block_size, block_index, position = header[statistics_end:]
+        # A generator may be shared by the games created with it, so the state is restored into a copy.
+        self.piece_generator = self.piece_generator.clone()
+        self.piece_generator.set_state(int.from_bytes(entropy, 'little'), PieceGenerator.MODES[mode], block_size,
+                                       block_index, position)
+
+        self.falling_piece_id, self.falling_piece_rotation = falling_piece_id, falling_rotation
+        self.next_piece_id, self.next_piece_rotation = next_piece_id, next_rotation
+        self.falling_piece_location[:] = row, col
+
+        cells = self.rows * self.columns
+        offset = self.SNAPSHOT_HEADER.size
+        packed_blocks = np.frombuffer(snapshot, dtype=np.uint8, count=(cells + 7) // 8, offset=offset)
+        offset += len(packed_blocks)
+        frozen_blocks = np.unpackbits(packed_blocks, count=cells).reshape((self.rows, self.columns))
+        frozen_blocks_color_code = np.frombuffer(snapshot, dtype=np.uint8, count=cells, offset=offset)
+        self.restore_frozen_blocks(frozen_blocks, frozen_blocks_color_code.reshape((self.rows, self.columns)))
+        update_falling_blocks(self)
+
+    def restore_frozen_blocks(self, frozen_blocks: np.ndarray, frozen_blocks_color_code: np.ndarray):
+        self.frozen_blocks[:, :] = frozen_blocks
+        self.frozen_blocks_color_code[:, :] = frozen_blocks_color_code
+        self.column_heights[:] = compute_column_heights(frozen_blocks)
+        self.row_fill_counts[:] = (frozen_blocks != 0).sum(axis=1)
+        self.locked_rows = None
+        self.board_hash = hash_board(frozen_blocks)
+
+    @property
+    def zobrist_hash(self) -> int:
+        # Hash of the whole position: frozen blocks, falling piece and its location, next piece.
+        return self.board_hash ^ hash_pieces(self.falling_piece_id, self.falling_piece_rotation,
+                                             self.falling_piece_location, self.next_piece_id, self.next_piece_rotation)
+
+    @property
+    def falling_piece(self) -> Piece:
+        return PIECE_ROTATIONS[self.falling_piece_id][self.falling_piece_rotation]
+
+    @falling_piece.setter
+    def falling_piece(self, piece: Piece):
+        self.falling_piece_id = piece.piece_id
+        self.falling_piece_rotation = piece.rotation
+
+    @property
+    def next_falling_piece(self) -> Piece:
+        return PIECE_ROTATIONS[self.next_piece_id][self.next_piece_rotation]
+
+    @next_falling_piece.setter
+    def next_falling_piece(self, piece: Piece):
+        self.next_piece_id = piece.piece_id
+        self.next_piece_rotation = piece.rotation
+
+    @property
+    def data(self):
+        if self.falling_blocks_dirty:
+            paint_falling_blocks(self)
+        return self._data
+
     def numpy(self):
         return np.vstack((self.frozen_blocks, self.falling_blocks)).reshape((-1, self.rows, self.columns))
 
@@ -68,11 +208,11 @@ class GameState:
 
     @property
     def frozen_blocks(self):
-        return self.data[self.DATA_INDEX_FROZEN_BLOCKS]
+        return self._data[self.DATA_INDEX_FROZEN_BLOCKS]
 
     @property
     def frozen_blocks_color_code(self):
-        return self.data[self.DATA_INDEX_FROZEN_BLOCKS_COLOR_CODE]
+        return self._data[self.DATA_INDEX_FROZEN_BLOCKS_COLOR_CODE]
 
     @property
     def falling_blocks(self):
@@ -93,59 +233,136 @@ class GameState:
 
 def is_piece_hitting_bottom_or_other_blocks(state: GameState):
     row, col = state.falling_piece_location
-    for i in range(SHAPE_BOX_SIZE):
-        for j in range(SHAPE_BOX_SIZE):
-            if state.falling_piece.shape[i * SHAPE_BOX_SIZE + j] == 1:
-                if row + i + 1 >= state.rows:
-                    return True
-                if state.frozen_blocks[row + i + 1][col + j] != 0:
-                    return True
+    frozen_blocks = state.frozen_blocks
+    for j, bottom in enumerate(state.falling_piece.geometry.bottom_profile):
+        if bottom >= 0:
+            if row + bottom + 1 >= state.rows:
+                return True
+            if frozen_blocks[row + bottom + 1, col + j] != 0:
+                return True
     return False
 
 
 def detect_out_of_boundary_or_collision(frozen_blocks: np.ndarray, falling_piece: Piece,
                                         falling_piece_location: np.ndarray) -> bool:
     piece_row, piece_col = falling_piece_location
-    falling_piece_shape = falling_piece.shape
-    for i in range(SHAPE_BOX_SIZE):
-        for j in range(SHAPE_BOX_SIZE):
-            if falling_piece_shape[i * SHAPE_BOX_SIZE + j] == 1:
-                row = piece_row + i
-                col = piece_col + j
-                if row < 0 or row >= GAME_ROWS:
-                    return True
-                if col < 0 or col >= GAME_COLS:
-                    return True
-                if frozen_blocks[row][col] == 1:
-                    return True
+    geometry = falling_piece.geometry
+    if geometry.bounding_box is None:
+        return False
+    min_col, max_col = geometry.column_range
+    if piece_col < min_col or piece_col > max_col:
+        return True
+    top, _, bottom, _ = geometry.bounding_box
+    if piece_row + top < 0 or piece_row + bottom >= GAME_ROWS:
+        return True
+    for i, j in geometry.cells:
+        if frozen_blocks[piece_row + i, piece_col + j] == 1:
+            return True
     return False
 
 
 def update_falling_blocks(state: GameState):
+    state.falling_blocks_dirty = True
+
+
+def paint_falling_blocks(state: GameState):
+    state.falling_blocks_dirty = False
     state.falling_blocks[:, :] = 0
     state.falling_blocks_color_code[:, :] = 0
 
     if state.falling_piece:
         row, col = state.falling_piece_location
-        for i in range(SHAPE_BOX_SIZE):
-            for j in range(SHAPE_BOX_SIZE):
-                if state.falling_piece.shape[i * SHAPE_BOX_SIZE + j] == 1:
-                    state.falling_blocks[row + i, col + j] = 1
-                    state.falling_blocks_color_code[row + i, col + j] = state.falling_piece.color
+        geometry = state.falling_piece.geometry
+        state.falling_blocks[row + geometry.cell_rows, col + geometry.cell_cols] = 1
+        state.falling_blocks_color_code[row + geometry.cell_rows, col + geometry.cell_cols] = state.falling_piece.color
 
 
 def froze_falling_piece(state: GameState):
     row, col = state.falling_piece_location
-    for i in range(SHAPE_BOX_SIZE):
-        for j in range(SHAPE_BOX_SIZE):
-            if state.falling_piece.shape[i * SHAPE_BOX_SIZE + j] == 1:
-                state.frozen_blocks[row + i][col + j] = 1
-                state.frozen_blocks_color_code[row + i][col + j] = state.falling_piece.color
+    geometry = state.falling_piece.geometry
+    state.frozen_blocks[row + geometry.cell_rows, col + geometry.cell_cols] = 1
+    state.frozen_blocks_color_code[row + geometry.cell_rows, col + geometry.cell_cols] = state.falling_piece.color
+    for j, top in enumerate(geometry.top_profile):
+        if top >= 0:
+            state.column_heights[col + j] = max(state.column_heights[col + j], state.rows - row - top)
+    if geometry.bounding_box is not None:
+        top, _, bottom, _ = geometry.bounding_box
+        state.row_fill_counts[row + top:row + bottom + 1] += geometry.row_cell_counts[top:bottom + 1]
+        state.locked_rows = (row + top, row + bottom + 1)
+    for i, j in geometry.cells:
+        state.board_hash ^= CELL_KEYS[row + i][col + j]
+
+
+def compute_column_heights(frozen_blocks: np.ndarray) -> np.ndarray:
+    # Works on a single (rows, columns) board as well as on a stack of them.
+    filled = frozen_blocks != 0
+    return np.where(filled.any(axis=-2), frozen_blocks.shape[-2] - filled.argmax(axis=-2), 0)
+
+
+def compute_landing_rows(column_heights: np.ndarray, rows, piece_ids, rotations, columns) -> np.ndarray:
+    # Batched skyline_landing_row: where pieces dropped from above the skyline come to rest. column_heights is
+    # either one skyline shared by all pieces or one skyline per piece.
+    column_heights = np.broadcast_to(column_heights, (len(columns), column_heights.shape[-1]))
+    box_columns = np.clip(columns[:, None] + np.arange(SHAPE_BOX_SIZE), 0, column_heights.shape[-1] - 1)
+    bottoms = PIECE_BOTTOM_PROFILES[piece_ids, rotations]
+    landing_rows = rows - np.take_along_axis(column_heights, box_columns, axis=1) - 1 - bottoms
+    return np.where(bottoms >= 0, landing_rows, rows).min(axis=1)
+
+
+def compact_complete_rows(planes: np.ndarray, complete: np.ndarray) -> np.ndarray:
+    # planes is (n, planes, rows, columns) and complete is (n, rows). A stable sort on "kept" gathers the
+    # complete rows to the top while keeping the order of the others, then those top rows are emptied.
+    order = np.argsort(~complete, axis=1, kind='stable')
+    planes = np.take_along_axis(planes, order[:, None, :, None], axis=2)
+    cleared = np.arange(complete.shape[1]) < complete.sum(axis=1)[:, None]
+    planes[np.broadcast_to(cleared[:, None, :, None], planes.shape)] = 0
+    return planes
+
+
+def compute_piece_cells(piece_ids, rotations, rows, columns):
+    # Board coordinates of the cells of pieces located at (rows, columns), two (n, SHAPE_CELL_COUNT) arrays.
+    cell_rows = rows[:, None] + PIECE_CELL_ROWS[piece_ids, rotations]
+    cell_cols = columns[:, None] + PIECE_CELL_COLS[piece_ids, rotations]
+    return cell_rows, cell_cols
+
+
+def detect_collisions(frozen_blocks: np.ndarray, piece_ids, rotations, rows, columns) -> np.ndarray:
+    # Batched detect_out_of_boundary_or_collision, frozen_blocks holding one board per piece.
+    board_rows, board_cols = frozen_blocks.shape[-2:]
+    cell_rows, cell_cols = compute_piece_cells(piece_ids, rotations, rows, columns)
+    outside = (cell_rows < 0) | (cell_rows >= board_rows) | (cell_cols < 0) | (cell_cols >= board_cols)
+    blocked = frozen_blocks[np.arange(len(piece_ids))[:, None],
+                            np.clip(cell_rows, 0, board_rows - 1),
+                            np.clip(cell_cols, 0, board_cols - 1)] != 0
+    return (outside | blocked).any(axis=1)
+
+
+def compute_stage_rows(frozen_blocks: np.ndarray, piece_ids, rotations) -> np.ndarray:
+    # Batched stage_next_falling_piece: the first of rows 0, -1, -2, -3 at which each piece fits, or the row
+    # count of the board where it does not fit at all and the game is over.
+    board_rows = frozen_blocks.shape[-2]
+    columns = np.full(len(piece_ids), SPAWN_COL)
+    stage_rows = np.full(len(piece_ids), board_rows)
+    for attempt in reversed(range(SHAPE_BOX_SIZE)):
+        rows = np.full(len(piece_ids), -attempt)
+        stage_rows[~detect_collisions(frozen_blocks, piece_ids, rotations, rows, columns)] = -attempt
+    return stage_rows
+
+
+def skyline_landing_row(state: GameState):
+    # Row at which the falling piece comes to rest when dropped from above the skyline, None for an empty piece.
+    col = state.falling_piece_location[1]
+    landing_row = None
+    for j, bottom in enumerate(state.falling_piece.geometry.bottom_profile):
+        if bottom >= 0:
+            row = state.rows - state.column_heights[col + j] - 1 - bottom
+            if landing_row is None or row < landing_row:
+                landing_row = row
+    return landing_row
 
 
 def generate_next_falling_piece(state: GameState):
-    piece = get_random_piece()
-    state.next_falling_piece = piece
+    state.next_piece_id, state.next_piece_rotation = state.piece_generator.next_piece()
 
 
 def stage_next_falling_piece(state: GameState):
@@ -154,7 +371,7 @@ def stage_next_falling_piece(state: GameState):
     stage_location = None
 
     while attempt < SHAPE_BOX_SIZE:
-        stage_location = np.array([0 - attempt, (GAME_COLS - SHAPE_BOX_SIZE) / 2], dtype=np.int)
+        stage_location = [0 - attempt, (GAME_COLS - SHAPE_BOX_SIZE) // 2]
         conflict = detect_out_of_boundary_or_collision(state.frozen_blocks, state.next_falling_piece, stage_location)
         if not conflict:
             break
@@ -165,7 +382,7 @@ def stage_next_falling_piece(state: GameState):
         update_falling_blocks(state)
         return False
 
-    state.falling_piece = state.next_falling_piece
+    state.falling_piece_id, state.falling_piece_rotation = state.next_piece_id, state.next_piece_rotation
     state.falling_piece_location[:] = stage_location
     update_falling_blocks(state)
     return True
@@ -187,15 +404,25 @@ def move_piece_right(state: GameState):
 
 
 def rotate_piece(state: GameState):
-    state.falling_piece.rotation = (state.falling_piece.rotation + 1) % len(state.falling_piece.shapes)
+    state.falling_piece_rotation = (state.falling_piece_rotation + 1) % len(PIECE_ROTATIONS[state.falling_piece_id])
     update_falling_blocks(state)
 
 
 def drop_piece(state: GameState):
-    move_distance = 0
-    while not is_piece_hitting_bottom_or_other_blocks(state):
-        move_piece_down(state)
-        move_distance += 1
+    row = state.falling_piece_location[0]
+    landing_row = skyline_landing_row(state)
+    if landing_row is None:
+        return 0
+
+    if landing_row >= row:
+        move_distance = landing_row - row
+        state.falling_piece_location[0] = landing_row
+    else:
+        # The piece is already below the skyline (tucked under an overhang), fall back to scanning row by row.
+        move_distance = 0
+        while not is_piece_hitting_bottom_or_other_blocks(state):
+            state.falling_piece_location[0] += 1
+            move_distance += 1
     update_falling_blocks(state)
     return move_distance
 
@@ -230,8 +457,7 @@ def user_move_piece_right(state: GameState):
 
 
 def user_rotate_piece(state: GameState):
-    neo_piece = copy.copy(state.falling_piece)
-    neo_piece.rotation = (neo_piece.rotation + 1) % len(neo_piece.shapes)
+    neo_piece = state.falling_piece.rotated()
     conflict = detect_out_of_boundary_or_collision(state.frozen_blocks, neo_piece, state.falling_piece_location)
     if not conflict:
         rotate_piece(state)
@@ -246,19 +472,102 @@ def user_drop_piece(state: GameState):
         state.score += move_distance * 2
 
 
-def remove_complete_lines(state: GameState):
-    removed_lines_count = 0
-    blocks = state.frozen_blocks
-    data = state.data
+# Cells passed by the key presses of a macro action, relative to the row of the piece, cached per
+# (piece_id, from_rotation, rotation, from_col, column): (cell_rows, cell_cols, min_row, max_row, lowest_rows),
+# lowest_rows listing (column, lowest row offset) pairs for the skyline test, or None when the way leaves the
+# board sideways.
+PLACEMENT_PATH_CELLS = {}
+
+
+def compute_placement_path_cells(piece_id, from_rotation, rotation, from_col, column):
+    rotation_count = len(PIECE_ROTATIONS[piece_id])
+    turns = (rotation - from_rotation) % rotation_count
+    path_rotations = (from_rotation + np.arange(1, turns + 1)) % rotation_count
+    path_columns = np.arange(min(from_col, column), max(from_col, column) + 1)
+    cell_rows = np.concatenate((PIECE_CELL_ROWS[piece_id, path_rotations].ravel(),
+                                np.tile(PIECE_CELL_ROWS[piece_id, rotation], len(path_columns))))
+    cell_cols = np.concatenate(((from_col + PIECE_CELL_COLS[piece_id, path_rotations]).ravel(),
+                                (path_columns[:, None] + PIECE_CELL_COLS[piece_id, rotation]).ravel()))
+    if cell_cols.min() < 0 or cell_cols.max() >= GAME_COLS:
+        return None
+    lowest_rows = tuple((int(c), int(cell_rows[cell_cols == c].max())) for c in np.unique(cell_cols))
+    return cell_rows, cell_cols, int(cell_rows.min()), int(cell_rows.max()), lowest_rows
+
+
+def place_piece(state: GameState, rotation, column):
+    # Macro action: turns the falling piece to `rotation` and shifts it to shape box column `column` at its
+    # current row in one go, then hard drops it, counting the same operations and score as the key presses
+    # would. The column is clamped to the board as the walls would stop the moves. The cells the piece passes
+    # on the way (each rotation step in place, then every column of the shift) are checked in a single
+    # lookup; if any of them is blocked the state is left untouched and False is returned, as it is once the
+    # game is over and there is no piece to place.
+    piece_id = state.falling_piece_id
+    if piece_id == PIECE_NONE.piece_id:
+        return False
+    from_rotation = state.falling_piece_rotation
+    rotation_count = len(PIECE_ROTATIONS[piece_id])
+    rotation %= rotation_count
+    min_col, max_col = PIECE_ROTATIONS[piece_id][rotation].geometry.column_range
+    column = min(max(column, min_col), max_col)
+    row, col = state.falling_piece_location
+
+    key = (piece_id, from_rotation, rotation, col, column)
+    path = PLACEMENT_PATH_CELLS.get(key, False)
+    if path is False:
+        path = PLACEMENT_PATH_CELLS[key] = compute_placement_path_cells(*key)
+    if path is None:
+        return False
+    cell_rows, cell_cols, min_row, max_row, lowest_rows = path
+    if row + min_row < 0 or row + max_row >= state.rows:
+        return False
+    # A way that stays above the skyline is free; otherwise look at the cells themselves.
+    skyline = state.rows - row
+    column_heights = state.column_heights.tolist()
+    if any(lowest_row >= skyline - column_heights[c] for c, lowest_row in lowest_rows):
+        if state.frozen_blocks[row + cell_rows, cell_cols].any():
+            return False
+
+    state.op_rotate += (rotation - from_rotation) % rotation_count
+    state.op_left += max(col - column, 0)
+    state.op_right += max(column - col, 0)
+    state.falling_piece_rotation = rotation
+    state.falling_piece_location[1] = column
+    user_drop_piece(state)
+    return True
 
-    row = GAME_ROWS - 1
-    while row >= 0:
-        while blocks[row].sum() == GAME_COLS:
-            data[:, 1:row + 1] = data[:, 0:row]
-            data[:, 0] = 0
-            removed_lines_count = removed_lines_count + 1
-        row = row - 1
 
+def remove_complete_lines(state: GameState):
+    blocks = state.frozen_blocks
+    counts = state.row_fill_counts
+
+    # Only the rows the last frozen piece went through can have become complete.
+    first, last = state.locked_rows if state.locked_rows is not None else (0, state.rows)
+    complete_rows = first + np.flatnonzero(counts[first:last] == state.columns)
+    removed_lines_count = len(complete_rows)
+
+    if removed_lines_count > 0:
+        # Complete rows are gathered to the top and emptied, the others keep their order below them.
+        kept = np.ones(state.rows, dtype=bool)
+        kept[complete_rows] = False
+        order = np.concatenate((complete_rows, np.flatnonzero(kept)))
+        data = state._data[:GameState.DATA_INDEX_FALLING_BLOCKS]
+        data[:] = data[:, order]
+        data[:, :removed_lines_count] = 0
+        counts[:] = counts[order]
+        counts[:removed_lines_count] = 0
+        state.board_hash = hash_board(blocks)
+
+        heights = state.column_heights
+        heights -= removed_lines_count
+        # A column whose top block sat on a removed line may now have holes right under its new top.
+        top_blocks = blocks[state.rows - np.maximum(heights, 1), np.arange(state.columns)]
+        for col in np.flatnonzero((heights > 0) & (top_blocks == 0)):
+            heights[col] = compute_column_heights(blocks[:, col:col + 1])[0]
+
+    score_removed_lines(state, removed_lines_count)
+
+
+def score_removed_lines(state: GameState, removed_lines_count):
     if removed_lines_count == 0:
         gained_score = 0
     elif removed_lines_count == 1:
@@ -279,8 +588,47 @@ def remove_complete_lines(state: GameState):
     state.score = state.score + gained_score
 
 
-def new_game():
-    state = GameState(GAME_ROWS, GAME_COLS)
+def enumerate_piece_placements(frozen_blocks: np.ndarray, column_heights: np.ndarray, piece: Piece, row=0):
+    rows, columns = frozen_blocks.shape
+    piece_id = piece.piece_id
+    placement_rotations = PIECE_PLACEMENT_ROTATIONS[piece_id]
+    placement_columns = PIECE_PLACEMENT_COLUMNS[piece_id]
+    landing_rows = compute_landing_rows(column_heights, rows, piece_id, placement_rotations, placement_columns)
+
+    # Only placements reachable by dropping from the current row that end up fully inside the board.
+    legal = (landing_rows >= row) & (landing_rows + PIECE_ROW_RANGES[piece_id, placement_rotations, 0] >= 0)
+    placement_rotations = placement_rotations[legal]
+    placement_columns = placement_columns[legal]
+    landing_rows = landing_rows[legal]
+    count = len(landing_rows)
+
+    boards = np.repeat(frozen_blocks[None], count, axis=0)
+    cell_rows = landing_rows[:, None] + PIECE_CELL_ROWS[piece_id, placement_rotations]
+    cell_cols = placement_columns[:, None] + PIECE_CELL_COLS[piece_id, placement_rotations]
+    boards[np.arange(count)[:, None], cell_rows, cell_cols] = 1
+
+    complete = boards.all(axis=2)
+    lines_cleared = complete.sum(axis=1)
+    clearing = lines_cleared > 0
+    if clearing.any():
+        boards[clearing] = compact_complete_rows(boards[clearing, None], complete[clearing])[:, 0]
+
+    rotation_times = (placement_rotations - piece.rotation) % PIECE_ROTATION_COUNTS[piece_id]
+    actions = rotation_times * columns + placement_columns + 1
+    score_deltas = (landing_rows - row) * 2 + REMOVED_LINES_SCORES[lines_cleared]
+    return Placements(actions, placement_rotations, placement_columns, landing_rows, boards,
+                      lines_cleared, score_deltas)
+
+
+def enumerate_placements(state: GameState) -> Placements:
+    return enumerate_piece_placements(state.frozen_blocks, state.column_heights, state.falling_piece,
+                                      state.falling_piece_location[0])
+
+
+def new_game(seed=None, piece_generator=None):
+    if piece_generator is None:
+        piece_generator = PieceGenerator(seed)
+    state = GameState(GAME_ROWS, GAME_COLS, piece_generator)
     generate_next_falling_piece(state)
     stage_next_falling_piece(state)
     generate_next_falling_piece(state)
@@ -315,5 +663,34 @@ def test_game():
         step(state)
 
 
+def _test_snapshot(moves=40):
+    # Restores snapshots taken mid-game into games with another generator, for seeds of every kind that
+    # PieceGenerator takes, and checks that both engines then play on exactly like the original game.
+    import game_bitboard
+    print("_test_snapshot")
+
+    seeds = (None, 0, 7, np.int64(7), 2 ** 127, 2 ** 130, [1, 2])
+    for engine in (sys.modules[__name__], game_bitboard):
+        for seed in seeds:
+            for mode in PieceGenerator.MODES:
+                state = engine.new_game(piece_generator=PieceGenerator(seed, mode))
+                for _ in range(moves):
+                    engine.user_drop_piece(state)
+                    engine.step(state)
+                snapshot = state.snapshot()
+                restored = engine.new_game(seed=12345)
+                restored.restore(snapshot)
+                assert restored.snapshot() == snapshot, (engine.__name__, seed, mode)
+
+                for _ in range(moves):
+                    for s in (state, restored):
+                        engine.user_drop_piece(s)
+                        engine.step(s)
+                    assert np.array_equal(state.data, restored.data), (engine.__name__, seed, mode)
+                    assert (state.next_piece_id, state.score) == (restored.next_piece_id, restored.score)
+    print('ok')
+
+
 if __name__ == "__main__":
     test_game()
+    _test_snapshot()
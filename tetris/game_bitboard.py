@@ -0,0 +1,356 @@
+import sys
+import numpy as np
+from game import *
+
+# Drop-in replacement for the engine in game.py. The frozen board is kept as one integer per row
+# (bit c set means column c is occupied) and every piece rotation is pre-shifted into row masks for
+# each possible column, so collision, freezing and line detection become a few AND/OR operations.
+
+FULL_ROW_MASK = (1 << GAME_COLS) - 1
+COLUMN_BITS = 1 << np.arange(GAME_COLS)
+
+
+def build_shape_row_masks(geometry: PieceGeometry):
+    masks = {}
+    min_col, max_col = geometry.column_range
+    for col in range(min_col, max_col + 1):
+        row_masks = [0] * SHAPE_BOX_SIZE
+        for i, j in geometry.cells:
+            row_masks[i] |= 1 << (col + j)
+        masks[col] = tuple((i, mask) for i, mask in enumerate(row_masks) if mask)
+    return masks
+
+
+SHAPE_ROW_MASKS = {}
+for _piece in [PIECE_NONE] + PIECES:
+    for _shape, _geometry in zip(_piece.shapes, _piece.geometries):
+        SHAPE_ROW_MASKS[id(_shape)] = build_shape_row_masks(_geometry)
+
+
+def unpack_rows(rows):
+    return (np.array(rows)[:, None] & COLUMN_BITS != 0).astype(GameState.DATA_DTYPE)
+
+
+class BitboardGameState(GameState):
+    __slots__ = ('frozen_rows', 'frozen_colors')
+
+    def __init__(self, rows, columns, piece_generator=None):
+        self.rows = rows
+        self.columns = columns
+        self.status = GameStatus.RUNNING
+        self.score = 0
+        self.op_left = 0
+        self.op_right = 0
+        self.op_rotate = 0
+        self.op_soft_drop = 0
+        self.op_hard_drop = 0
+        self.single_line_cleared = 0
+        self.double_lines_cleared = 0
+        self.triple_lines_cleared = 0
+        self.tetris_line_cleared = 0  # i.e. quadruple lines cleared
+        self.soft_drop_distance = 0
+        self.hard_drop_distance = 0
+        self.frozen_rows = [0] * rows
+        self.frozen_colors = np.zeros((rows, columns), dtype=self.DATA_DTYPE)
+        self.board_hash = 0
+        self.falling_piece = PIECE_NONE
+        self.falling_piece_location = [0, 0]
+        self.next_falling_piece = PIECE_NONE
+        self.piece_generator = piece_generator if piece_generator is not None else PieceGenerator()
+
+    def clone(self):
+        state = object.__new__(type(self))
+        state.rows = self.rows
+        state.columns = self.columns
+        state.status = self.status
+        for name in self.STATISTICS:
+            setattr(state, name, getattr(self, name))
+        state.frozen_rows = list(self.frozen_rows)
+        state.frozen_colors = self.frozen_colors.copy()
+        state.board_hash = self.board_hash
+        state.falling_piece_id = self.falling_piece_id
+        state.falling_piece_rotation = self.falling_piece_rotation
+        state.falling_piece_location = list(self.falling_piece_location)
+        state.next_piece_id = self.next_piece_id
+        state.next_piece_rotation = self.next_piece_rotation
+        state.piece_generator = self.piece_generator.clone()
+        return state
+
+    def restore_frozen_blocks(self, frozen_blocks: np.ndarray, frozen_blocks_color_code: np.ndarray):
+        self.frozen_rows = [int(row) for row in (frozen_blocks.astype(int) * COLUMN_BITS).sum(axis=1)]
+        self.frozen_colors[:, :] = frozen_blocks_color_code
+        self.board_hash = hash_board(frozen_blocks)
+
+    @property
+    def data(self):
+        return np.stack((self.frozen_blocks, self.frozen_blocks_color_code,
+                         self.falling_blocks, self.falling_blocks_color_code))
+
+    @property
+    def frozen_blocks(self):
+        return unpack_rows(self.frozen_rows)
+
+    @property
+    def frozen_blocks_color_code(self):
+        return self.frozen_colors.copy()
+
+    @property
+    def falling_blocks(self):
+        blocks = np.zeros((self.rows, self.columns), dtype=self.DATA_DTYPE)
+        row, col = self.falling_piece_location
+        geometry = self.falling_piece.geometry
+        blocks[row + geometry.cell_rows, col + geometry.cell_cols] = 1
+        return blocks
+
+    @property
+    def falling_blocks_color_code(self):
+        return self.falling_blocks * self.falling_piece.color
+
+
+def is_piece_hitting_bottom_or_other_blocks(state: BitboardGameState):
+    row, col = state.falling_piece_location
+    frozen_rows = state.frozen_rows
+    for i, mask in SHAPE_ROW_MASKS[id(state.falling_piece.shape)][col]:
+        if row + i + 1 >= state.rows:
+            return True
+        if frozen_rows[row + i + 1] & mask:
+            return True
+    return False
+
+
+def detect_out_of_boundary_or_collision(frozen_rows: list, falling_piece: Piece, falling_piece_location) -> bool:
+    piece_row, piece_col = falling_piece_location
+    masks = SHAPE_ROW_MASKS[id(falling_piece.shape)].get(piece_col)
+    if masks is None:
+        return True
+    for i, mask in masks:
+        row = piece_row + i
+        if row < 0 or row >= GAME_ROWS:
+            return True
+        if frozen_rows[row] & mask:
+            return True
+    return False
+
+
+def update_falling_blocks(state: BitboardGameState):
+    # Falling blocks are derived from the piece and its location on access, nothing to repaint.
+    pass
+
+
+def froze_falling_piece(state: BitboardGameState):
+    row, col = state.falling_piece_location
+    for i, mask in SHAPE_ROW_MASKS[id(state.falling_piece.shape)][col]:
+        state.frozen_rows[row + i] |= mask
+    geometry = state.falling_piece.geometry
+    state.frozen_colors[row + geometry.cell_rows, col + geometry.cell_cols] = state.falling_piece.color
+    for i, j in geometry.cells:
+        state.board_hash ^= CELL_KEYS[row + i][col + j]
+
+
+def stage_next_falling_piece(state: BitboardGameState):
+    attempt = 0
+    conflict = False
+    stage_location = None
+
+    while attempt < SHAPE_BOX_SIZE:
+        stage_location = [0 - attempt, (GAME_COLS - SHAPE_BOX_SIZE) // 2]
+        conflict = detect_out_of_boundary_or_collision(state.frozen_rows, state.next_falling_piece, stage_location)
+        if not conflict:
+            break
+        attempt = attempt + 1
+
+    if conflict:
+        state.falling_piece = PIECE_NONE
+        return False
+
+    state.falling_piece = state.next_falling_piece
+    state.falling_piece_location[:] = stage_location
+    return True
+
+
+def move_piece_down(state: BitboardGameState):
+    state.falling_piece_location[0] = state.falling_piece_location[0] + 1
+
+
+def move_piece_left(state: BitboardGameState):
+    state.falling_piece_location[1] = state.falling_piece_location[1] - 1
+
+
+def move_piece_right(state: BitboardGameState):
+    state.falling_piece_location[1] = state.falling_piece_location[1] + 1
+
+
+def rotate_piece(state: BitboardGameState):
+    state.falling_piece_rotation = (state.falling_piece_rotation + 1) % len(PIECE_ROTATIONS[state.falling_piece_id])
+
+
+def drop_piece(state: BitboardGameState):
+    if not state.falling_piece.geometry.cells:
+        # PIECE_NONE, once the game is over, never hits bottom.
+        return 0
+    move_distance = 0
+    while not is_piece_hitting_bottom_or_other_blocks(state):
+        move_piece_down(state)
+        move_distance += 1
+    return move_distance
+
+
+def user_move_piece_down(state: BitboardGameState):
+    neo_location = [state.falling_piece_location[0] + 1, state.falling_piece_location[1]]
+    conflict = detect_out_of_boundary_or_collision(state.frozen_rows, state.falling_piece, neo_location)
+    if not conflict:
+        move_piece_down(state)
+        state.soft_drop_distance += 1
+        state.op_soft_drop += 1
+        state.score += 1
+
+
+def user_move_piece_left(state: BitboardGameState):
+    neo_location = [state.falling_piece_location[0], state.falling_piece_location[1] - 1]
+    conflict = detect_out_of_boundary_or_collision(state.frozen_rows, state.falling_piece, neo_location)
+    if not conflict:
+        move_piece_left(state)
+        state.op_left += 1
+
+
+def user_move_piece_right(state: BitboardGameState):
+    neo_location = [state.falling_piece_location[0], state.falling_piece_location[1] + 1]
+    conflict = detect_out_of_boundary_or_collision(state.frozen_rows, state.falling_piece, neo_location)
+    if not conflict:
+        move_piece_right(state)
+        state.op_right += 1
+
+
+def user_rotate_piece(state: BitboardGameState):
+    neo_piece = state.falling_piece.rotated()
+    conflict = detect_out_of_boundary_or_collision(state.frozen_rows, neo_piece, state.falling_piece_location)
+    if not conflict:
+        rotate_piece(state)
+        state.op_rotate += 1
+
+
+def user_drop_piece(state: BitboardGameState):
+    move_distance = drop_piece(state)
+    if move_distance > 0:
+        state.op_hard_drop += 1
+        state.hard_drop_distance += move_distance
+        state.score += move_distance * 2
+
+
+def place_piece(state: BitboardGameState, rotation, column):
+    piece_id = state.falling_piece_id
+    if piece_id == PIECE_NONE.piece_id:
+        return False
+    rotation_count = len(PIECE_ROTATIONS[piece_id])
+    rotation %= rotation_count
+    pieces = PIECE_ROTATIONS[piece_id]
+    min_col, max_col = pieces[rotation].geometry.column_range
+    column = min(max(column, min_col), max_col)
+    row, col = state.falling_piece_location
+
+    turns = (rotation - state.falling_piece_rotation) % rotation_count
+    for turn in range(1, turns + 1):
+        piece = pieces[(state.falling_piece_rotation + turn) % rotation_count]
+        if detect_out_of_boundary_or_collision(state.frozen_rows, piece, [row, col]):
+            return False
+    for path_col in range(min(col, column), max(col, column) + 1):
+        if detect_out_of_boundary_or_collision(state.frozen_rows, pieces[rotation], [row, path_col]):
+            return False
+
+    state.op_rotate += turns
+    state.op_left += max(col - column, 0)
+    state.op_right += max(column - col, 0)
+    state.falling_piece_rotation = rotation
+    state.falling_piece_location[1] = column
+    user_drop_piece(state)
+    return True
+
+
+def remove_complete_lines(state: BitboardGameState):
+    kept_rows = [row for row in range(GAME_ROWS) if state.frozen_rows[row] != FULL_ROW_MASK]
+    removed_lines_count = GAME_ROWS - len(kept_rows)
+
+    if removed_lines_count > 0:
+        state.frozen_rows = [0] * removed_lines_count + [state.frozen_rows[row] for row in kept_rows]
+        state.frozen_colors[removed_lines_count:] = state.frozen_colors[kept_rows]
+        state.frozen_colors[:removed_lines_count] = 0
+        state.board_hash = hash_board(state.frozen_blocks)
+
+    score_removed_lines(state, removed_lines_count)
+
+
+def new_game(seed=None, piece_generator=None):
+    if piece_generator is None:
+        piece_generator = PieceGenerator(seed)
+    state = BitboardGameState(GAME_ROWS, GAME_COLS, piece_generator)
+    generate_next_falling_piece(state)
+    stage_next_falling_piece(state)
+    generate_next_falling_piece(state)
+    return state
+
+
+def step(state: BitboardGameState):
+    if state.status == GameStatus.TERMINATED:
+        return
+
+    piece_has_hit_bottom_or_other_blocks = is_piece_hitting_bottom_or_other_blocks(state)
+    if piece_has_hit_bottom_or_other_blocks:
+        froze_falling_piece(state)
+        remove_complete_lines(state)
+        stage_ok = stage_next_falling_piece(state)
+        generate_next_falling_piece(state)
+        if not stage_ok:
+            state.status = GameStatus.TERMINATED
+    else:
+        move_piece_down(state)
+
+
+def test_game():
+    state = new_game()
+    for i in range(1, 1000):
+        print("======== No. ", i, "========")
+        print(state.numpy())
+
+        if state.status == GameStatus.TERMINATED:
+            return
+        step(state)
+
+
+def _test_engines_match(seeds=40, moves=300):
+    # Plays the same random moves on seeded games of both engines and checks that they stay identical. Ended
+    # games are dropped and placed once more, which must do nothing, and replaced by new seeded ones.
+    import game
+    print("_test_engines_match")
+
+    engines = game, sys.modules[__name__]
+    user_moves = ('user_move_piece_down', 'user_move_piece_left', 'user_move_piece_right', 'user_rotate_piece',
+                  'user_drop_piece')
+    for seed in range(seeds):
+        rng = np.random.default_rng(seed)
+        states = [engine.new_game(seed=seed) for engine in engines]
+        for move in range(moves):
+            choice = rng.integers(len(user_moves) + 2)
+            rotation, column = rng.integers(4), rng.integers(-2, GAME_COLS)
+            for engine, state in zip(engines, states):
+                if choice < len(user_moves):
+                    getattr(engine, user_moves[choice])(state)
+                else:
+                    engine.place_piece(state, rotation, column)
+                engine.step(state)
+
+            expected, actual = states
+            for name in ('status', 'falling_piece_id', 'falling_piece_rotation', 'falling_piece_location',
+                         'next_piece_id', 'next_piece_rotation', 'board_hash') + GameState.STATISTICS:
+                assert getattr(expected, name) == getattr(actual, name), (seed, move, name)
+            assert np.array_equal(expected.data, actual.data), (seed, move)
+
+            if expected.status == GameStatus.TERMINATED:
+                for engine, state in zip(engines, states):
+                    assert engine.drop_piece(state) == 0 and not engine.place_piece(state, rotation, column)
+                states = [engine.new_game(seed=seed * moves + move) for engine in engines]
+    print('ok')
+
+
+if __name__ == "__main__":
+    test_game()
+    _test_engines_match()
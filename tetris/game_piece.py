@@ -1,9 +1,15 @@
+from collections import namedtuple
 from enum import Enum
 import random
 import copy
 
+import numpy as np
+
 from color import Color
 
+GAME_ROWS = 20
+GAME_COLS = 10
+
 SHAPE_BOX_SIZE = 4
 
 SHAPE_NONE = [
@@ -128,9 +134,48 @@ SHAPE_Z = [
 ]
 
 
+# Per-rotation geometry, computed once so that the engine never rescans the 16 cells of a shape box.
+#   cells           -- (row, col) offsets of the occupied cells inside the shape box
+#   cell_rows/cols  -- the same offsets as index arrays, for fancy indexing into the board
+#   bounding_box    -- (top, left, bottom, right) of the occupied cells, inclusive; None for an empty shape
+#   bottom_profile  -- per shape box column, the lowest occupied row, or -1 if the column is empty
+#   top_profile     -- per shape box column, the highest occupied row, or -1 if the column is empty
+#   column_range    -- (min, max) piece location column keeping every cell inside the board, inclusive
+#   row_cell_counts -- number of occupied cells in each shape box row
+PieceGeometry = namedtuple('PieceGeometry', ('cells', 'cell_rows', 'cell_cols', 'bounding_box',
+                                             'bottom_profile', 'top_profile', 'column_range', 'row_cell_counts'))
+
+
+def compute_piece_geometry(shape):
+    cells = tuple((i, j) for i in range(SHAPE_BOX_SIZE) for j in range(SHAPE_BOX_SIZE)
+                  if shape[i * SHAPE_BOX_SIZE + j] == 1)
+    cell_rows = np.array([i for i, _ in cells], dtype=int)
+    cell_cols = np.array([j for _, j in cells], dtype=int)
+
+    bottom_profile = [-1] * SHAPE_BOX_SIZE
+    top_profile = [-1] * SHAPE_BOX_SIZE
+    for i, j in cells:
+        bottom_profile[j] = max(bottom_profile[j], i)
+        top_profile[j] = i if top_profile[j] == -1 else min(top_profile[j], i)
+
+    if cells:
+        bounding_box = (min(i for i, _ in cells), min(j for _, j in cells),
+                        max(i for i, _ in cells), max(j for _, j in cells))
+        column_range = (-bounding_box[1], GAME_COLS - 1 - bounding_box[3])
+    else:
+        bounding_box = None
+        column_range = (-SHAPE_BOX_SIZE + 1, GAME_COLS - 1)
+
+    row_cell_counts = np.bincount(cell_rows, minlength=SHAPE_BOX_SIZE)
+    return PieceGeometry(cells, cell_rows, cell_cols, bounding_box,
+                         tuple(bottom_profile), tuple(top_profile), column_range, row_cell_counts)
+
+
 class Piece:
-    def __init__(self, shapes, color):
+    def __init__(self, piece_id, shapes, color):
+        self.piece_id = piece_id
         self.shapes = shapes
+        self.geometries = [compute_piece_geometry(shape) for shape in shapes]
         self.rotation = 0
         self.color = color
 
@@ -138,20 +183,179 @@ class Piece:
     def shape(self):
         return self.shapes[self.rotation]
 
+    @property
+    def geometry(self) -> PieceGeometry:
+        return self.geometries[self.rotation]
+
+    def rotated(self):
+        return get_piece(self.piece_id, (self.rotation + 1) % len(self.shapes))
+
+    def __deepcopy__(self, memo):
+        # Pieces are shared and never modified by the engine, see PIECE_ROTATIONS.
+        return self
 
-PIECE_NONE = Piece(SHAPE_NONE, Color.WHITE)
-PIECE_I = Piece(SHAPE_I, Color.LIGHT_BLUE)
-PIECE_O = Piece(SHAPE_O, Color.YELLOW)
-PIECE_L = Piece(SHAPE_L, Color.ORANGE)
-PIECE_J = Piece(SHAPE_J, Color.BLUE)
-PIECE_T = Piece(SHAPE_T, Color.PURPLE)
-PIECE_S = Piece(SHAPE_S, Color.GREEN)
-PIECE_Z = Piece(SHAPE_Z, Color.RED)
+
+PIECE_NONE = Piece(0, SHAPE_NONE, Color.WHITE)
+PIECE_I = Piece(1, SHAPE_I, Color.LIGHT_BLUE)
+PIECE_O = Piece(2, SHAPE_O, Color.YELLOW)
+PIECE_L = Piece(3, SHAPE_L, Color.ORANGE)
+PIECE_J = Piece(4, SHAPE_J, Color.BLUE)
+PIECE_T = Piece(5, SHAPE_T, Color.PURPLE)
+PIECE_S = Piece(6, SHAPE_S, Color.GREEN)
+PIECE_Z = Piece(7, SHAPE_Z, Color.RED)
 
 PIECES = [PIECE_I, PIECE_O, PIECE_L, PIECE_J, PIECE_T, PIECE_S, PIECE_Z]
+PIECES_BY_ID = [PIECE_NONE] + PIECES
+
+
+def _rotate_copy(piece: Piece, rotation):
+    if rotation == 0:
+        return piece
+    piece = copy.copy(piece)
+    piece.rotation = rotation
+    return piece
+
+
+# One shared instance per (piece_id, rotation). The engine treats these as immutable: rotating a piece swaps
+# in another instance instead of changing `rotation`, so spawning and rotating never allocate.
+PIECE_ROTATIONS = [[_rotate_copy(piece, rotation) for rotation in range(len(piece.shapes))]
+                   for piece in PIECES_BY_ID]
+
+
+def get_piece(piece_id, rotation=0) -> Piece:
+    return PIECE_ROTATIONS[piece_id][rotation]
+
+# The geometry tables stacked into arrays indexed by [piece_id, rotation], for engines that handle many
+# pieces at once. Rotations past a piece's own count wrap around, and PIECE_NONE (id 0) has no cells.
+MAX_ROTATIONS = 4
+SHAPE_CELL_COUNT = 4
+
+PIECE_ROTATION_COUNTS = np.array([len(piece.shapes) for piece in PIECES_BY_ID], dtype=int)
+PIECE_COLORS = np.array([piece.color for piece in PIECES_BY_ID], dtype=int)
+PIECE_CELL_ROWS = np.zeros((len(PIECES_BY_ID), MAX_ROTATIONS, SHAPE_CELL_COUNT), dtype=int)
+PIECE_CELL_COLS = np.zeros((len(PIECES_BY_ID), MAX_ROTATIONS, SHAPE_CELL_COUNT), dtype=int)
+PIECE_BOTTOM_PROFILES = np.full((len(PIECES_BY_ID), MAX_ROTATIONS, SHAPE_BOX_SIZE), -1, dtype=int)
+PIECE_COLUMN_RANGES = np.zeros((len(PIECES_BY_ID), MAX_ROTATIONS, 2), dtype=int)
+PIECE_ROW_RANGES = np.zeros((len(PIECES_BY_ID), MAX_ROTATIONS, 2), dtype=int)
+for _piece in PIECES:
+    for _rotation in range(MAX_ROTATIONS):
+        _geometry = _piece.geometries[_rotation % len(_piece.shapes)]
+        PIECE_CELL_ROWS[_piece.piece_id, _rotation] = _geometry.cell_rows
+        PIECE_CELL_COLS[_piece.piece_id, _rotation] = _geometry.cell_cols
+        PIECE_BOTTOM_PROFILES[_piece.piece_id, _rotation] = _geometry.bottom_profile
+        PIECE_COLUMN_RANGES[_piece.piece_id, _rotation] = _geometry.column_range
+        PIECE_ROW_RANGES[_piece.piece_id, _rotation] = _geometry.bounding_box[0], _geometry.bounding_box[2]
+
+
+def compute_distinct_rotations(piece: Piece):
+    # Rotations of a piece that are not mere translations of an earlier one, e.g. one of the two S shapes.
+    seen = set()
+    rotations = []
+    for rotation, geometry in enumerate(piece.geometries):
+        top, left, _, _ = geometry.bounding_box
+        normalized_cells = frozenset((i - top, j - left) for i, j in geometry.cells)
+        if normalized_cells not in seen:
+            seen.add(normalized_cells)
+            rotations.append(rotation)
+    return rotations
+
+
+# Every distinct (rotation, location column) a piece can be placed at, as two aligned arrays per piece id.
+PIECE_PLACEMENT_ROTATIONS = [np.zeros(0, dtype=int)]
+PIECE_PLACEMENT_COLUMNS = [np.zeros(0, dtype=int)]
+for _piece in PIECES:
+    _placements = [(_rotation, _col) for _rotation in compute_distinct_rotations(_piece)
+                   for _col in range(_piece.geometries[_rotation].column_range[0],
+                                     _piece.geometries[_rotation].column_range[1] + 1)]
+    PIECE_PLACEMENT_ROTATIONS.append(np.array([_rotation for _rotation, _ in _placements], dtype=int))
+    PIECE_PLACEMENT_COLUMNS.append(np.array([_col for _, _col in _placements], dtype=int))
 
 
 def get_random_piece():
-    candidate = copy.copy(random.choice(PIECES))
-    candidate.rotation = random.randint(0, len(candidate.shapes) - 1)
-    return candidate
+    candidate = random.choice(PIECES)
+    return get_piece(candidate.piece_id, random.randint(0, len(candidate.shapes) - 1))
+
+
+class PieceGenerator:
+    # Seedable source of (piece_id, rotation) pairs owned by a single game, so that games are reproducible and
+    # parallel workers share no hidden state. In 'uniform' mode every piece is equally likely, in 'bag' mode
+    # pieces come in shuffled bags of all seven. Pieces are pre-generated block_size at a time; every block is
+    # derived from the seed and the block index alone, so copies of a generator stay independent and cheap.
+    MODES = ('uniform', 'bag')
+
+    def __init__(self, seed=None, mode='uniform', block_size=4096):
+        if mode not in self.MODES:
+            raise ValueError('unknown piece generator mode: {}'.format(mode))
+        seed_sequence = np.random.SeedSequence(seed)
+        if isinstance(seed_sequence.entropy, (int, np.integer)) and int(seed_sequence.entropy) < 1 << 128:
+            self.entropy = int(seed_sequence.entropy)
+        else:
+            # Seed sequences and ints past 128 bits are hashed down to 128 bits, which is what snapshots hold.
+            self.entropy = int.from_bytes(seed_sequence.generate_state(4).tobytes(), 'little')
+        self.mode = mode
+        self.block_size = block_size - block_size % len(PIECES) if mode == 'bag' else block_size
+        self.block_index = -1
+        self.position = 0
+        self.piece_ids = np.zeros(0, dtype=int)
+        self.rotations = np.zeros(0, dtype=int)
+        self._piece_ids = []
+        self._rotations = []
+
+    def _generate_block(self):
+        self.block_index += 1
+        rng = np.random.default_rng([self.entropy, self.block_index])
+        if self.mode == 'bag':
+            bags = np.tile(np.arange(1, len(PIECES_BY_ID)), (self.block_size // len(PIECES), 1))
+            piece_ids = rng.permuted(bags, axis=1).ravel()
+        else:
+            piece_ids = rng.integers(1, len(PIECES_BY_ID), size=self.block_size)
+        self.piece_ids = piece_ids
+        self.rotations = (rng.random(self.block_size) * PIECE_ROTATION_COUNTS[piece_ids]).astype(int)
+        self._piece_ids = self.piece_ids.tolist()
+        self._rotations = self.rotations.tolist()
+        self.position = 0
+
+    def next_piece(self):
+        if self.position >= len(self._piece_ids):
+            self._generate_block()
+        position = self.position
+        self.position += 1
+        return self._piece_ids[position], self._rotations[position]
+
+    def take(self, n):
+        piece_ids = []
+        rotations = []
+        while n > 0:
+            if self.position >= len(self.piece_ids):
+                self._generate_block()
+            stop = min(self.position + n, len(self.piece_ids))
+            piece_ids.append(self.piece_ids[self.position:stop])
+            rotations.append(self.rotations[self.position:stop])
+            n -= stop - self.position
+            self.position = stop
+        if not piece_ids:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        return np.concatenate(piece_ids), np.concatenate(rotations)
+
+    def get_state(self):
+        # Everything the generator needs to go on from where it is: (entropy, mode, block_size, block_index,
+        # position). The pre-generated block is derived from the rest.
+        return self.entropy, self.mode, self.block_size, self.block_index, self.position
+
+    def set_state(self, entropy, mode, block_size, block_index, position):
+        if (entropy, mode, block_size, block_index) != (self.entropy, self.mode, self.block_size, self.block_index):
+            self.entropy, self.mode, self.block_size = entropy, mode, block_size
+            self.block_index = block_index - 1
+            if block_index >= 0:
+                self._generate_block()
+            else:
+                self.piece_ids = self.rotations = np.zeros(0, dtype=int)
+                self._piece_ids, self._rotations = [], []
+        self.position = position
+
+    def clone(self):
+        # The pre-generated blocks are never modified in place, so they can be shared.
+        return copy.copy(self)
+
+    def __deepcopy__(self, memo):
+        return self.clone()
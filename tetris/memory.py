@@ -1,8 +1,26 @@
 from collections import namedtuple, deque
+import copy
+import json
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import queue
 import random
+import threading
+import time
+import numpy as np
+import torch
+from game import *
 
 Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward'))
 
+# A sampled batch of transitions, every field a tensor with the batch along its first axis. `discounts` are the
+# factors to apply to the value of next_states (gamma^n for an n-step transition), `indices` the buffer slots
+# the batch came from (a NumPy array, to hand back to update_priorities) and `weights` the importance sampling
+# weights of a prioritized buffer, None for uniform sampling.
+TransitionBatch = namedtuple('TransitionBatch', ('states', 'actions', 'next_states', 'rewards', 'discounts',
+                                                 'dones', 'indices', 'weights'))
+
 
 class ReplayMemory:
     def __init__(self, capacity):
@@ -15,4 +33,516 @@ class ReplayMemory:
         return random.sample(self.memory, batch_size)
 
     def __len__(self):
-        return len(self.memory)
\ No newline at end of file
+        return len(self.memory)
+
+
+# Ring buffer over preallocated arrays. A transition's state and next state are stored next to each other
+# as uint8 planes, so a batch is assembled with one gather per array and converted to float on the device.
+# push takes the planes as arrays of state_shape, next_state None marking the end of a game.
+#
+# With n_steps > 1 the buffer stores n-step transitions: pushes are collected in a pending window per `env`
+# and once it holds n_steps of them, its first state is stored with the discounted sum of the window's
+# rewards and the last next state as bootstrap state. When a game ends every pending transition is stored
+# right away with the rewards up to the end; end_episode does the same, bootstrapping, for games cut short.
+class ArrayReplayMemory:
+    ARRAY_FIELDS = ('states', 'actions', 'rewards', 'discounts', 'dones')
+
+    def __init__(self, capacity, state_shape, device=torch.device('cpu'), seed=None, n_steps=1, gamma=1.0):
+        self.capacity = capacity
+        self.device = device
+        self.state_shape = tuple(state_shape)
+        self.n_steps = n_steps
+        self.gamma = gamma
+        self.pending = {}
+        self.position = 0
+        self.size = 0
+        self.rng = np.random.default_rng(seed)
+        self.allocate()
+
+    def allocate(self):
+        self.states = np.zeros((self.capacity, 2) + self.state_shape, dtype=np.uint8)
+        self.actions = np.zeros(self.capacity, dtype=np.int64)
+        self.rewards = np.zeros(self.capacity, dtype=np.float32)
+        self.discounts = np.zeros(self.capacity, dtype=np.float32)
+        self.dones = np.zeros(self.capacity, dtype=bool)
+
+    def encode_states(self, state, next_state):
+        states = np.zeros((2,) + self.state_shape, dtype=np.uint8)
+        states[0] = state
+        if next_state is not None:
+            states[1] = next_state
+        return states
+
+    def decode_states(self, states):
+        return states
+
+    def write_states(self, i, state, next_state):
+        self.states[i] = self.encode_states(state, next_state)
+
+    def push(self, state, action, next_state, reward, env=0):
+        window = self.pending.setdefault(env, deque())
+        window.append((state, action, next_state, reward))
+        if next_state is None:
+            self.end_episode(env)
+        elif len(window) >= self.n_steps:
+            self.store_window(window)
+
+    def end_episode(self, env=0):
+        window = self.pending.get(env)
+        while window:
+            self.store_window(window)
+
+    def store_window(self, window):
+        state, action = window[0][:2]
+        next_state = window[-1][2]
+        reward = sum(self.gamma ** k * transition[3] for k, transition in enumerate(window))
+        self.store(state, action, next_state, reward, self.gamma ** len(window))
+        window.popleft()
+
+    def store(self, state, action, next_state, reward, discount):
+        i = self.position
+        self.write_states(i, state, next_state)
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.discounts[i] = discount
+        self.dones[i] = next_state is None
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample_indices(self, batch_size):
+        return self.rng.integers(0, self.size, size=batch_size)
+
+    def gather_states(self, indices):
+        return self.decode_states(self.states[indices])
+
+    def gather_rows(self, indices):
+        # Copies of the stored rows at indices: states, actions, rewards, discounts and dones.
+        return (self.gather_states(indices), self.actions[indices], self.rewards[indices], self.discounts[indices],
+                self.dones[indices])
+
+    def gather(self, indices, weights=None) -> TransitionBatch:
+        states, actions, rewards, discounts, dones = self.gather_rows(indices)
+        states = torch.from_numpy(states).to(self.device).float()
+        if weights is not None:
+            weights = torch.from_numpy(weights).to(self.device)
+        return TransitionBatch(states[:, 0], torch.from_numpy(actions).to(self.device), states[:, 1],
+                               torch.from_numpy(rewards).to(self.device), torch.from_numpy(discounts).to(self.device),
+                               torch.from_numpy(dones).to(self.device), indices, weights)
+
+    def sample(self, batch_size) -> TransitionBatch:
+        return self.gather(self.sample_indices(batch_size))
+
+    def update_priorities(self, indices, errors):
+        # Uniform sampling has no priorities.
+        pass
+
+    def state_dict(self):
+        # Copy of the contents, write position, pending n-step windows and sampling RNG, for checkpoints.
+        state = {
+            'position': self.position,
+            'size': self.size,
+            'pending': copy.deepcopy(self.pending),
+            'rng': self.rng.bit_generator.state,
+        }
+        for name in self.ARRAY_FIELDS:
+            state[name] = getattr(self, name)[:self.size].copy()
+        return state
+
+    def load_state_dict(self, state):
+        for name in self.ARRAY_FIELDS:
+            if name in state:
+                getattr(self, name)[:len(state[name])] = state[name]
+        if 'size' in state:
+            self.position = state['position']
+            self.size = state['size']
+        self.pending = copy.deepcopy(state['pending'])
+        self.rng.bit_generator.state = state['rng']
+
+    def __len__(self):
+        return self.size
+
+
+# Samples batches from a replay memory on a background thread and keeps up to `depth` of them ready in a
+# bounded queue, so that the learner does not wait for sampling and collation. `lock` guards the memory: hold
+# it around every push, end_episode and update_priorities done while the prefetcher runs. Queued batches were
+# sampled before the latest pushes and priority updates, by at most depth batches.
+class BatchPrefetcher:
+    def __init__(self, memory, batch_size, depth=2, lock=None, telemetry=None):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.lock = lock if lock is not None else threading.Lock()
+        self.telemetry = telemetry
+        self.batches = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                start = time.perf_counter()
+                batch = self.memory.sample(self.batch_size) if len(self.memory) >= self.batch_size else None
+            if batch is None:
+                self.stopped.wait(0.01)
+                continue
+            if self.telemetry is not None:
+                self.telemetry.add('prefetch_sample', time.perf_counter() - start)
+            while not self.stopped.is_set():
+                try:
+                    self.batches.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def get(self) -> TransitionBatch:
+        # Blocks until a batch is ready, i.e. once the memory holds batch_size transitions.
+        return self.batches.get()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+# Binary sum tree over `capacity` leaves stored in one array: node k has children 2k and 2k + 1, the root is
+# node 1 and leaf i is node leaf_offset + i. Batches of leaves are updated and searched level by level, so
+# both cost O(batch * log capacity) in a handful of NumPy operations.
+class SumTree:
+    def __init__(self, capacity):
+        self.depth = max(int(np.ceil(np.log2(capacity))), 1)
+        self.leaf_offset = 1 << self.depth
+        self.tree = np.zeros(2 * self.leaf_offset)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, indices):
+        return self.tree[self.leaf_offset + np.asarray(indices)]
+
+    def set(self, index, value):
+        node = self.leaf_offset + index
+        tree = self.tree
+        tree[node] = value
+        while node > 1:
+            node //= 2
+            tree[node] = tree[2 * node] + tree[2 * node + 1]
+
+    def update(self, indices, values):
+        nodes = self.leaf_offset + np.asarray(indices)
+        self.tree[nodes] = values
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        # Leaf whose prefix sum interval contains each value in [0, total).
+        values = np.array(values, dtype=float)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            left_sums = self.tree[left]
+            go_right = values >= left_sums
+            values -= np.where(go_right, left_sums, 0)
+            nodes = left + go_right
+        return nodes - self.leaf_offset
+
+
+# Proportional prioritized replay: transitions are sampled with probability p_i^alpha / sum p^alpha,
+# p_i = |TD error| + eps, new transitions getting the largest priority seen so far. Batches carry importance
+# sampling weights (N P(i))^-beta normalized by the largest weight of the batch, beta being annealed from
+# beta_start to 1 over beta_steps sampled batches.
+class PrioritizedReplayMemory(ArrayReplayMemory):
+    def __init__(self, capacity, state_shape, device=torch.device('cpu'), seed=None, n_steps=1, gamma=1.0,
+                 alpha=0.6, beta_start=0.4, beta_steps=100000, eps=1e-3):
+        super().__init__(capacity, state_shape, device, seed, n_steps, gamma)
+        self.alpha = alpha
+        self.beta_start = beta_start
+        self.beta_steps = beta_steps
+        self.eps = eps
+        self.priorities = SumTree(capacity)
+        self.max_priority = 1.0
+        self.batches_sampled = 0
+
+    @property
+    def beta(self):
+        return min(1.0, self.beta_start + (1.0 - self.beta_start) * self.batches_sampled / self.beta_steps)
+
+    def store(self, state, action, next_state, reward, discount):
+        self.priorities.set(self.position, self.max_priority ** self.alpha)
+        super().store(state, action, next_state, reward, discount)
+
+    def sample_indices(self, batch_size):
+        # Stratified: one value from each of batch_size equal slices of the total priority.
+        total = self.priorities.total
+        values = (np.arange(batch_size) + self.rng.random(batch_size)) * (total / batch_size)
+        return np.minimum(self.priorities.find(values), self.size - 1)
+
+    def sample(self, batch_size) -> TransitionBatch:
+        indices = self.sample_indices(batch_size)
+        probabilities = self.priorities[indices] / self.priorities.total
+        weights = (self.size * probabilities) ** -self.beta
+        self.batches_sampled += 1
+        return self.gather(indices, (weights / weights.max()).astype(np.float32))
+
+    def update_priorities(self, indices, errors):
+        priorities = np.abs(errors) + self.eps
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.priorities.update(indices, priorities ** self.alpha)
+
+    def state_dict(self):
+        state = super().state_dict()
+        state['priorities'] = self.priorities.tree.copy()
+        state['max_priority'] = self.max_priority
+        state['batches_sampled'] = self.batches_sampled
+        return state
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.priorities.tree[:] = state['priorities']
+        self.max_priority = state['max_priority']
+        self.batches_sampled = state['batches_sampled']
+
+
+# ArrayReplayMemory kept in np.memmap files under `directory`, so that it can be far larger than RAM and
+# outlives the training process. The 0/1 planes are bit-packed, a transition of two 2x20x10 inputs takes
+# 100 bytes of planes plus 17 bytes of action, reward, discount and done flag.
+#
+# header.json records the capacity, state shape, write position and size. It is only rewritten by flush(),
+# after the arrays have been flushed, and always through an atomic rename; reopening the directory resumes
+# from the last flush, transitions stored after it and pending n-step windows are dropped. flush() runs every
+# flush_interval stored transitions.
+class MemmapReplayMemory(ArrayReplayMemory):
+    HEADER_FILENAME = 'header.json'
+
+    def __init__(self, directory, capacity, state_shape, device=torch.device('cpu'), seed=None, n_steps=1,
+                 gamma=1.0, flush_interval=10000):
+        self.directory = directory
+        self.state_size = int(np.prod(state_shape))
+        self.flush_interval = flush_interval
+        self.pushes_since_flush = 0
+        super().__init__(capacity, state_shape, device, seed, n_steps, gamma)
+
+    def allocate(self):
+        os.makedirs(self.directory, exist_ok=True)
+        header_filepath = os.path.join(self.directory, self.HEADER_FILENAME)
+        mode = 'w+'
+        if os.path.exists(header_filepath):
+            with open(header_filepath) as f:
+                header = json.load(f)
+            if header['capacity'] != self.capacity or tuple(header['state_shape']) != self.state_shape:
+                raise ValueError('replay memory in {} has capacity {} and state shape {}'.format(
+                    self.directory, header['capacity'], tuple(header['state_shape'])))
+            self.position = header['position']
+            self.size = header['size']
+            mode = 'r+'
+
+        packed_size = (2 * self.state_size + 7) // 8
+        self.states = self.open_array('states', np.uint8, (self.capacity, packed_size), mode)
+        self.actions = self.open_array('actions', np.int64, (self.capacity,), mode)
+        self.rewards = self.open_array('rewards', np.float32, (self.capacity,), mode)
+        self.discounts = self.open_array('discounts', np.float32, (self.capacity,), mode)
+        self.dones = self.open_array('dones', bool, (self.capacity,), mode)
+        if mode == 'w+':
+            self.flush()
+
+    def state_dict(self):
+        # The contents stay in the memmap files. Loading the state rewinds the write position and size to the
+        # checkpoint's, but slots written after it keep the transitions stored since, so the contents are not
+        # those of the checkpoint.
+        self.flush()
+        return {'position': self.position, 'size': self.size, 'pending': copy.deepcopy(self.pending),
+                'rng': self.rng.bit_generator.state}
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.flush()
+
+    def open_array(self, name, dtype, shape, mode):
+        return np.memmap(os.path.join(self.directory, name + '.bin'), dtype=dtype, mode=mode, shape=shape)
+
+    def encode_states(self, state, next_state):
+        return np.packbits(super().encode_states(state, next_state))
+
+    def decode_states(self, states):
+        states = np.unpackbits(states, axis=-1, count=2 * self.state_size)
+        return states.reshape((len(states), 2) + self.state_shape)
+
+    def store(self, state, action, next_state, reward, discount):
+        super().store(state, action, next_state, reward, discount)
+        self.pushes_since_flush += 1
+        if self.pushes_since_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        for array in (self.states, self.actions, self.rewards, self.discounts, self.dones):
+            array.flush()
+        header = {
+            'capacity': self.capacity,
+            'state_shape': list(self.state_shape),
+            'position': self.position,
+            'size': self.size,
+        }
+        header_filepath = os.path.join(self.directory, self.HEADER_FILENAME)
+        with open(header_filepath + '.tmp', 'w') as f:
+            json.dump(header, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(header_filepath + '.tmp', header_filepath)
+        self.pushes_since_flush = 0
+
+
+# ArrayReplayMemory whose arrays, write position and size live in shared memory, so that actor processes can
+# push into it while a learner process samples from it. Stores and the row copies of sampling are serialized
+# by `lock`. Pickling the buffer (e.g. passing it to a Process) attaches the other process to the same
+# segments; pending n-step windows stay per process. The creating process releases the segments with unlink().
+class SharedReplayMemory(ArrayReplayMemory):
+    def __init__(self, capacity, state_shape, device=torch.device('cpu'), seed=None, n_steps=1, gamma=1.0,
+                 lock=None):
+        self.lock = lock if lock is not None else multiprocessing.Lock()
+        self.segments = {}
+        self.counters = self.create_array('counters', np.int64, (2,))
+        super().__init__(capacity, state_shape, device, seed, n_steps, gamma)
+
+    @property
+    def position(self):
+        return int(self.counters[0])
+
+    @position.setter
+    def position(self, value):
+        self.counters[0] = value
+
+    @property
+    def size(self):
+        return int(self.counters[1])
+
+    @size.setter
+    def size(self, value):
+        self.counters[1] = value
+
+    def create_array(self, name, dtype, shape):
+        segment = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+        self.segments[name] = (segment, dtype, shape)
+        return np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+
+    def allocate(self):
+        self.states = self.create_array('states', np.uint8, (self.capacity, 2) + self.state_shape)
+        self.actions = self.create_array('actions', np.int64, (self.capacity,))
+        self.rewards = self.create_array('rewards', np.float32, (self.capacity,))
+        self.discounts = self.create_array('discounts', np.float32, (self.capacity,))
+        self.dones = self.create_array('dones', bool, (self.capacity,))
+
+    def store(self, state, action, next_state, reward, discount):
+        with self.lock:
+            super().store(state, action, next_state, reward, discount)
+
+    def gather_rows(self, indices):
+        # Copied under the lock, so that a row is never read while an actor is storing into it.
+        with self.lock:
+            return super().gather_rows(indices)
+
+    def __getstate__(self):
+        state = {key: value for key, value in self.__dict__.items() if key not in self.ARRAY_FIELDS + ('counters',)}
+        state['segments'] = {name: (segment.name, dtype, shape)
+                             for name, (segment, dtype, shape) in self.segments.items()}
+        state['pending'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.segments = {}
+        for name, (segment_name, dtype, shape) in state['segments'].items():
+            segment = shared_memory.SharedMemory(name=segment_name)
+            self.segments[name] = (segment, dtype, shape)
+            setattr(self, name, np.ndarray(shape, dtype=dtype, buffer=segment.buf))
+
+    def unlink(self):
+        for name, (segment, _, _) in self.segments.items():
+            setattr(self, name, None)
+            segment.close()
+            segment.unlink()
+        self.segments = {}
+
+
+# Compact pre-state of a transition: the bit-packed frozen board and the PIECE_FIELDS of the falling piece and
+# the next piece.
+GameStateKey = namedtuple('GameStateKey', ('board', 'pieces'))
+
+
+def encode_game_state(state: GameState) -> GameStateKey:
+    row, col = state.falling_piece_location
+    return GameStateKey(np.packbits(state.frozen_blocks), (state.falling_piece_id, state.falling_piece_rotation,
+                                                           row, col, state.next_piece_id, state.next_piece_rotation))
+
+
+# Replay memory storing transitions as deltas: the GameStateKey before the action and the placement the action
+# resolved to, i.e. the rotation and location of the falling piece once dropped. The input planes of a state
+# are rebuilt in batch at sample time from its key, and those of the next state by locking the placement,
+# clearing lines and staging the next piece, which reproduces step exactly. An n-step transition keeps the key
+# of its first state and the key and placement of its last one, 81 bytes instead of the 800 of
+# ArrayReplayMemory.
+class DeltaReplayMemory(ArrayReplayMemory):
+    ARRAY_FIELDS = ('boards', 'pieces', 'actions', 'rewards', 'discounts', 'dones')
+    PIECE_FIELDS = ('piece_id', 'rotation', 'row', 'col', 'next_piece_id', 'next_rotation',
+                    'placed_rotation', 'placed_row', 'placed_col')
+
+    def __init__(self, capacity, rows=GAME_ROWS, columns=GAME_COLS, device=torch.device('cpu'), seed=None,
+                 n_steps=1, gamma=1.0):
+        self.rows = rows
+        self.columns = columns
+        super().__init__(capacity, (2, rows, columns), device, seed, n_steps, gamma)
+
+    def allocate(self):
+        self.boards = np.zeros((self.capacity, 2, (self.rows * self.columns + 7) // 8), dtype=np.uint8)
+        self.pieces = np.zeros((self.capacity, 2, len(self.PIECE_FIELDS)), dtype=np.int8)
+        self.actions = np.zeros(self.capacity, dtype=np.int64)
+        self.rewards = np.zeros(self.capacity, dtype=np.float32)
+        self.discounts = np.zeros(self.capacity, dtype=np.float32)
+        self.dones = np.zeros(self.capacity, dtype=bool)
+
+    def push(self, state_key: GameStateKey, action, placement, reward, done, env=0):
+        # placement is (rotation, row, col) of the falling piece after perform_action, before step.
+        state = state_key, tuple(placement)
+        super().push(state, action, None if done else state, reward, env)
+
+    def write_states(self, i, state, next_state):
+        (state_key, placement) = state
+        self.boards[i, 0] = state_key.board
+        self.pieces[i, 0] = state_key.pieces + placement
+        if next_state is not None:
+            (state_key, placement) = next_state
+            self.boards[i, 1] = state_key.board
+            self.pieces[i, 1] = state_key.pieces + placement
+
+    def unpack_boards(self, boards):
+        boards = np.unpackbits(boards, axis=1, count=self.rows * self.columns)
+        return boards.reshape((len(boards), self.rows, self.columns))
+
+    def gather_states(self, indices):
+        n = len(indices)
+        batch = np.arange(n)[:, None]
+        states = np.zeros((n, 2) + self.state_shape, dtype=np.uint8)
+
+        piece_id, rotation, row, col = self.pieces[indices, 0, :4].astype(np.int64).T
+        states[:, 0, 0] = self.unpack_boards(self.boards[indices, 0])
+        cell_rows, cell_cols = compute_piece_cells(piece_id, rotation, row, col)
+        states[batch, 0, 1, cell_rows, cell_cols] = 1
+
+        live = np.flatnonzero(~self.dones[indices])
+        boards = self.unpack_boards(self.boards[indices[live], 1])
+        piece_id, _, _, _, next_piece_id, next_rotation, placed_rotation, placed_row, placed_col = \
+            self.pieces[indices[live], 1].astype(np.int64).T
+        cell_rows, cell_cols = compute_piece_cells(piece_id, placed_rotation, placed_row, placed_col)
+        boards[np.arange(len(live))[:, None], cell_rows, cell_cols] = 1
+        complete = boards.all(axis=2)
+        clearing = complete.any(axis=1)
+        if clearing.any():
+            boards[clearing] = compact_complete_rows(boards[clearing, None], complete[clearing])[:, 0]
+        states[live, 1, 0] = boards
+
+        stage_rows = compute_stage_rows(boards, next_piece_id, next_rotation)
+        staged = stage_rows < self.rows
+        live = live[staged]
+        cell_rows, cell_cols = compute_piece_cells(next_piece_id[staged], next_rotation[staged], stage_rows[staged],
+                                                   np.full(len(live), SPAWN_COL))
+        states[live[:, None], 1, 1, cell_rows, cell_cols] = 1
+        return states
@@ -1,9 +1,13 @@
+import copy
+import time
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from config import device
 
 
 class DQNBasicConv2d(nn.Module):
+    # Inputs have to be on the device of the model already.
     def __init__(self, h, w, out_size):
         super(DQNBasicConv2d, self).__init__()
         self.conv1 = nn.Conv2d(2, 8, kernel_size=3, stride=1)
@@ -22,14 +26,105 @@ class DQNBasicConv2d(nn.Module):
         self.head = nn.Linear(linear_input_size, out_size)
 
     def forward(self, x):
-        x = x.to(device)
         x = F.relu(self.bn1(self.conv1(x)))
         x = F.relu(self.bn2(self.conv2(x)))
         x = F.relu(self.bn3(self.conv3(x)))
-        return self.head(x.view(x.size(0), -1))
+        return self.head(x.flatten(1))
+
+
+BATCH_NORM_CONVS = (('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3'))
+
+
+def fold_batch_norm(model: DQNBasicConv2d, folded: DQNBasicConv2d = None) -> DQNBasicConv2d:
+    # Inference copy of model with every BatchNorm folded into the convolution before it, computing what
+    # model.eval() computes. Pass a previous copy as `folded` to refresh its weights in place, which keeps its
+    # memory format and any torch.compile wrapper around it valid.
+    if folded is None:
+        folded = copy.deepcopy(model).eval()
+        for _, bn_name in BATCH_NORM_CONVS:
+            setattr(folded, bn_name, nn.Identity())
+    with torch.no_grad():
+        for conv_name, bn_name in BATCH_NORM_CONVS:
+            conv, bn, folded_conv = getattr(model, conv_name), getattr(model, bn_name), getattr(folded, conv_name)
+            scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+            folded_conv.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+            folded_conv.bias.copy_((conv.bias - bn.running_mean) * scale + bn.bias)
+        folded.head.weight.copy_(model.head.weight)
+        folded.head.bias.copy_(model.head.bias)
+    return folded
+
+
+def autocast(enabled=True):
+    # bfloat16 autocast on the device of the models, a no-op when not enabled.
+    return torch.autocast(device.type, dtype=torch.bfloat16, enabled=enabled)
+
+
+def benchmark(h=20, w=10, out_size=40, batch_sizes=(1, 2048), seconds=2.0):
+    # Milliseconds per inference forward pass and per training step (forward, backward) of every execution
+    # mode against eager mode. torch.compile modes are timed after their compilation.
+    def run(f, x, train):
+        if train:
+            f(x).sum().backward()
+        else:
+            with torch.no_grad():
+                f(x)
+
+    def time_per_call(f, x, train):
+        for _ in range(3):
+            run(f, x, train)
+        calls, start = 0, time.perf_counter()
+        while calls < 10 or time.perf_counter() - start < seconds:
+            run(f, x, train)
+            calls += 1
+        return (time.perf_counter() - start) / calls * 1e3
+
+    def with_autocast(f):
+        def g(x):
+            with autocast():
+                return f(x)
+        return g
+
+    model = DQNBasicConv2d(h, w, out_size).to(device)
+    channels_last = copy.deepcopy(model).to(memory_format=torch.channels_last)
+
+    def inference_modes():
+        return {
+            'eager': model,
+            'folded': fold_batch_norm(model),
+            'channels_last': channels_last,
+            'bf16': with_autocast(model),
+            'compiled': torch.compile(copy.deepcopy(model)),
+            'folded+compiled': torch.compile(fold_batch_norm(model)),
+            'folded+channels_last+compiled': torch.compile(fold_batch_norm(channels_last)),
+        }
+
+    def training_modes():
+        return {
+            'eager': model,
+            'channels_last': channels_last,
+            'bf16': with_autocast(model),
+            'compiled': torch.compile(copy.deepcopy(model)),
+            'channels_last+compiled': torch.compile(copy.deepcopy(channels_last)),
+        }
+
+    for train in (False, True):
+        model.train(train)
+        channels_last.train(train)
+        modes = training_modes() if train else inference_modes()
+        for batch_size in batch_sizes:
+            if train and batch_size == 1:
+                continue
+            x = (torch.rand(batch_size, 2, h, w, device=device) > 0.5).float()
+            eager = None
+            for name, f in modes.items():
+                ms = time_per_call(f, x, train)
+                eager = ms if eager is None else eager
+                print('training' if train else 'inference', 'batch {}'.format(batch_size), name,
+                      '{:.3f} ms'.format(ms), 'x{:.2f}'.format(eager / ms), sep='\t')
 
 
 if __name__ == "__main__":
     from game import *
     model = DQNBasicConv2d(GAME_ROWS, GAME_COLS, GAME_ACTIONS)
-    print(model)
\ No newline at end of file
+    print(model)
+    benchmark(GAME_ROWS, GAME_COLS, 4 * GAME_COLS)
@@ -0,0 +1,226 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import time
+import numpy as np
+import torch
+from game import *
+from board_features import compute_board_features
+
+# Value of a position in which the next piece cannot be staged any more.
+TOP_OUT_VALUE = -1e5
+
+# Result of planning one move. `rotation` and `column` are the placement of the falling piece, `action` the
+# matching train_basic_conv2d_v2 macro action; `action` is None when the falling piece cannot be placed.
+PlanResult = namedtuple('PlanResult', ('action', 'rotation', 'column', 'value', 'nodes', 'elapsed',
+                                       'nodes_per_second'))
+
+
+class HeuristicEvaluator:
+    # Linear combination of board features, in game score units so that it adds up with score deltas.
+    DEFAULT_WEIGHTS = {
+        'aggregate_height': -5.0,
+        'holes': -35.0,
+        'bumpiness': -2.0,
+        'row_transitions': -3.0,
+        'column_transitions': -9.0,
+        'well_depths': -3.0,
+    }
+
+    def __init__(self, weights=None):
+        self.weights = dict(self.DEFAULT_WEIGHTS if weights is None else weights)
+
+    def __call__(self, boards: np.ndarray) -> np.ndarray:
+        features = compute_board_features(boards)._asdict()
+        values = np.zeros(len(boards))
+        for name, weight in self.weights.items():
+            feature = features[name]
+            values += weight * (feature.sum(axis=1) if feature.ndim == 2 else feature)
+        return values
+
+
+class DQNEvaluator:
+    # Values boards with max_a Q(board, a) of a DQNBasicConv2d in a single batched forward pass. The falling
+    # plane is left empty as the piece that will spawn on a leaf board is not known. Values of boards seen
+    # before come from the transposition cache instead of the network.
+    def __init__(self, model, cache_capacity=1 << 16):
+        self.model = model
+        self.cache = TranspositionCache(cache_capacity)
+
+    def evaluate_batch(self, boards: np.ndarray) -> np.ndarray:
+        inputs = np.zeros((len(boards), 2) + boards.shape[1:], dtype=np.float32)
+        inputs[:, 0] = boards
+        with torch.no_grad():
+            inputs = torch.from_numpy(inputs).to(next(self.model.parameters()).device)
+            return self.model(inputs).max(1)[0].cpu().numpy()
+
+    def __call__(self, boards: np.ndarray) -> np.ndarray:
+        keys = hash_boards(boards).tolist()
+        return np.array(self.cache.evaluate(keys, boards, self.evaluate_batch), dtype=float)
+
+
+def find_spawn_row(frozen_blocks: np.ndarray, piece: Piece):
+    # Row at which stage_next_falling_piece would stage the piece, None if the game would be over.
+    for attempt in range(SHAPE_BOX_SIZE):
+        if not detect_out_of_boundary_or_collision(frozen_blocks, piece, [-attempt, SPAWN_COL]):
+            return -attempt
+    return None
+
+
+class Search:
+    # Beam search over placements with an expectation over the unknown pieces. Instances are sent to worker
+    # processes, so everything they hold must be picklable.
+    def __init__(self, evaluator, beam_width, deadline, node_budget):
+        self.evaluator = evaluator
+        self.beam_width = beam_width
+        self.deadline = deadline
+        self.node_budget = node_budget
+        self.nodes = 0
+
+    def out_of_budget(self):
+        if self.deadline is not None and time.time() >= self.deadline:
+            return True
+        return self.node_budget is not None and self.nodes >= self.node_budget
+
+    def expand(self, frozen_blocks: np.ndarray, piece: Piece, row, depth, next_pieces):
+        # Returns the placements of piece and the value of each: its score delta plus either the leaf
+        # evaluation of the resulting board (depth 1) or the value of the plies below it. Values of different
+        # depths are not on the same scale, so past depth 1 only the beam placements searched to the full depth
+        # get a value; those outside the beam, not reached or cut short by the budget are valued -inf. A search
+        # cut short anywhere below a placement is cut short for it too, see expect.
+        placements = enumerate_piece_placements(frozen_blocks, compute_column_heights(frozen_blocks), piece, row)
+        self.nodes += len(placements.boards)
+        if len(placements.boards) == 0:
+            return placements, np.zeros(0)
+
+        values = placements.score_deltas + self.evaluator(placements.boards)
+        if depth <= 1:
+            return placements, values
+
+        deep_values = np.full(len(values), -np.inf)
+        for k in np.argsort(values)[::-1][:self.beam_width]:
+            if self.out_of_budget():
+                break
+            deep_values[k] = placements.score_deltas[k] + self.expect(placements.boards[k], depth - 1, next_pieces)
+        return placements, deep_values
+
+    def complete(self, values, depth):
+        # Whether the expand() that returned values searched all of its beam to the full depth.
+        return depth <= 1 or np.isfinite(values).sum() == min(self.beam_width, len(values))
+
+    def expect(self, frozen_blocks: np.ndarray, depth, next_pieces):
+        # next_pieces lists the pieces known to come next; past them every piece is equally likely. -inf when
+        # the budget ran out before every piece was searched to the full depth.
+        candidates = next_pieces[:1] if next_pieces else PIECES
+        total = 0.0
+        for piece in candidates:
+            row = find_spawn_row(frozen_blocks, piece)
+            if row is None:
+                total += TOP_OUT_VALUE
+                continue
+            _, values = self.expand(frozen_blocks, piece, row, depth, next_pieces[1:])
+            if not self.complete(values, depth):
+                return -np.inf
+            total += values.max() if len(values) > 0 else TOP_OUT_VALUE
+        return total / len(candidates)
+
+
+def expand_root_child(search: Search, frozen_blocks: np.ndarray, depth, next_pieces):
+    value = search.expect(frozen_blocks, depth, next_pieces)
+    return value, search.nodes
+
+
+class Planner:
+    # Plans the placement of the falling piece `depth` plies deep: the falling piece, then the known next
+    # piece, then an expectation over the seven pieces for every further ply. Only the beam_width most
+    # promising placements of every ply are expanded, and expansion stops early once the per-move time budget
+    # (seconds) or node budget is used up. With workers > 0 the beam of root children is expanded in a pool of
+    # processes; the evaluator then has to be picklable.
+    def __init__(self, evaluator=None, depth=3, beam_width=6, time_budget=None, node_budget=None, workers=0):
+        self.evaluator = evaluator if evaluator is not None else HeuristicEvaluator()
+        self.depth = depth
+        self.beam_width = beam_width
+        self.time_budget = time_budget
+        self.node_budget = node_budget
+        self.workers = workers
+        self.pool = ProcessPoolExecutor(workers) if workers > 0 else None
+        self.total_nodes = 0
+        self.total_elapsed = 0.0
+
+    @property
+    def nodes_per_second(self):
+        return self.total_nodes / self.total_elapsed if self.total_elapsed > 0 else 0.0
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def plan(self, state: GameState) -> PlanResult:
+        start = time.time()
+        deadline = start + self.time_budget if self.time_budget is not None else None
+        search = Search(self.evaluator, self.beam_width, deadline, self.node_budget)
+        next_pieces = [state.next_falling_piece]
+
+        # The placements are first valued one ply deep, which is what is left to choose from if the budget runs
+        # out before any of them is searched to the full depth.
+        placements, leaf_values = search.expand(state.frozen_blocks, state.falling_piece,
+                                                state.falling_piece_location[0], 1, next_pieces)
+        values = leaf_values
+        beam = np.argsort(leaf_values)[::-1][:self.beam_width]
+        if self.depth > 1 and len(beam) > 0:
+            # As in Search.expand, only the beam placements searched to the full depth compete.
+            values = np.full(len(leaf_values), -np.inf)
+            if self.pool is None:
+                for k in beam:
+                    if search.out_of_budget():
+                        break
+                    values[k] = placements.score_deltas[k] + search.expect(placements.boards[k], self.depth - 1,
+                                                                            next_pieces)
+            else:
+                if self.node_budget is not None:
+                    search.node_budget = max(self.node_budget - search.nodes, 0) // len(beam)
+                root_nodes, search.nodes = search.nodes, 0
+                futures = [self.pool.submit(expand_root_child, search, placements.boards[k], self.depth - 1,
+                                            next_pieces) for k in beam]
+                for k, future in zip(beam, futures):
+                    value, child_nodes = future.result()
+                    values[k] = placements.score_deltas[k] + value
+                    root_nodes += child_nodes
+                search.nodes = root_nodes
+            if not np.isfinite(values).any():
+                values = leaf_values
+        nodes = search.nodes
+
+        elapsed = time.time() - start
+        self.total_nodes += nodes
+        self.total_elapsed += elapsed
+        nodes_per_second = nodes / elapsed if elapsed > 0 else 0.0
+        if len(values) == 0:
+            return PlanResult(None, None, None, TOP_OUT_VALUE, nodes, elapsed, nodes_per_second)
+
+        best = int(np.argmax(values))
+        return PlanResult(int(placements.actions[best]), int(placements.rotations[best]),
+                          int(placements.columns[best]), float(values[best]), nodes, elapsed, nodes_per_second)
+
+
+def test_planner(moves=100, **kwargs):
+    planner = Planner(**kwargs)
+    state = new_game(seed=0)
+    try:
+        for move in range(moves):
+            if state.status == GameStatus.TERMINATED:
+                break
+            result = planner.plan(state)
+            if result.action is None:
+                break
+            place_piece(state, result.rotation, result.column)
+            step(state)
+    finally:
+        planner.close()
+    print(state)
+    print(state.blocks)
+    print('moves', move + 1, 'score', state.score, 'nodes/sec {:.0f}'.format(planner.nodes_per_second))
+
+
+if __name__ == "__main__":
+    test_planner()
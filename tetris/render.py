@@ -35,17 +35,14 @@ def draw_next_piece_hint(surface: pygame.Surface, state: GameState):
     container_pos_top = (surface.get_height() - container_height) / 2
 
     if state.next_falling_piece:
-        shape = state.next_falling_piece.shape
         color = COLOR_MAPPING[state.next_falling_piece.color]
-        for row in range(SHAPE_BOX_SIZE):
-            for col in range(SHAPE_BOX_SIZE):
-                if shape[row * SHAPE_BOX_SIZE + col] != 0:
-                    left = container_pos_left + gap_width + col * (gap_width + grid_size)
-                    top = container_pos_top + gap_width + row * (gap_width + grid_size)
-                    width = grid_size
-                    height = grid_size
-                    rect = pygame.Rect(left, top, width, height)
-                    pygame.draw.rect(surface, color, rect)
+        for row, col in state.next_falling_piece.geometry.cells:
+            left = container_pos_left + gap_width + col * (gap_width + grid_size)
+            top = container_pos_top + gap_width + row * (gap_width + grid_size)
+            width = grid_size
+            height = grid_size
+            rect = pygame.Rect(left, top, width, height)
+            pygame.draw.rect(surface, color, rect)
 
 
 def draw_tetris_container(surface: pygame.Surface, state: GameState):
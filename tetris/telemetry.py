@@ -0,0 +1,110 @@
+from collections import defaultdict
+import cProfile
+import json
+import os
+import pstats
+import time
+import torch
+
+
+# Per-phase wall-clock timing and counters of a training loop, reported as one JSON line per interval.
+# Phases are timed as laps: lap(phase) charges the time since the previous lap to phase, which costs one clock
+# read per phase and adds up to the whole wall-clock time of the loop, so shares are fractions of it. Time
+# spent on other threads is passed in with add() and reported apart from the shares.
+class Telemetry:
+    def __init__(self, filepath=None, interval=30.0):
+        self.filepath = filepath
+        self.interval = interval
+        self.phase_seconds = defaultdict(float)
+        self.background_seconds = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.window_start = self.last_lap = time.perf_counter()
+        if filepath is not None and os.path.dirname(filepath):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.phase_seconds[phase] += now - self.last_lap
+        self.last_lap = now
+
+    def add(self, phase, seconds):
+        self.background_seconds[phase] += seconds
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def report_due(self):
+        return time.perf_counter() - self.window_start >= self.interval
+
+    def report(self, **fields):
+        # Closes the current window: writes and returns its record, fields being added to it as they are.
+        now = time.perf_counter()
+        elapsed = max(now - self.window_start, 1e-9)
+        record = dict(fields)
+        record['time'] = time.time()
+        record['elapsed'] = elapsed
+        for name, n in self.counters.items():
+            record[name] = n
+            record[name + '_per_sec'] = n / elapsed
+        record['phase_share'] = {phase: seconds / elapsed for phase, seconds in self.phase_seconds.items()}
+        record['phase_seconds'] = dict(self.phase_seconds)
+        record['background_seconds'] = dict(self.background_seconds)
+        if self.filepath is not None:
+            with open(self.filepath, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+        self.phase_seconds.clear()
+        self.background_seconds.clear()
+        self.counters.clear()
+        self.window_start = now
+        return record
+
+
+def format_record(record, phases=5):
+    # One console line: the rates and the `phases` largest phase shares of a Telemetry record.
+    rates = ['{} {:.1f}'.format(name, value) for name, value in record.items() if name.endswith('_per_sec')]
+    shares = sorted(record['phase_share'].items(), key=lambda item: item[1], reverse=True)[:phases]
+    return '\t'.join(rates + ['{} {:.0%}'.format(phase, share) for phase, share in shares])
+
+
+# Profiles the steps first <= step < last of a loop that calls update(step) once per step, with torch.profiler
+# ('torch', a Chrome trace in output + '.json') or cProfile ('cprofile', pstats in output + '.prof'). A table
+# of the most expensive operations is printed when the window closes.
+class ProfileWindow:
+    def __init__(self, first, last, kind='torch', output='profile'):
+        if kind not in ('torch', 'cprofile'):
+            raise ValueError('unknown profiler {!r}'.format(kind))
+        self.first = first
+        self.last = last
+        self.kind = kind
+        self.output = output
+        self.profiler = None
+        self.done = False
+
+    def update(self, step):
+        if self.profiler is None and not self.done and self.first <= step < self.last:
+            self.start()
+        elif self.profiler is not None and step >= self.last:
+            self.stop()
+
+    def start(self):
+        if self.kind == 'torch':
+            self.profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU])
+            self.profiler.__enter__()
+        else:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop(self):
+        if self.profiler is None:
+            return
+        if self.kind == 'torch':
+            self.profiler.__exit__(None, None, None)
+            self.profiler.export_chrome_trace(self.output + '.json')
+            print(self.profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=20))
+        else:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.output + '.prof')
+            pstats.Stats(self.profiler).sort_stats('cumulative').print_stats(20)
+        self.profiler = None
+        self.done = True
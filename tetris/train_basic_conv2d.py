@@ -74,7 +74,7 @@ def optimize_model():
 
 def get_input(state: GameState):
     data = state.data[[GameState.DATA_INDEX_FROZEN_BLOCKS, GameState.DATA_INDEX_FALLING_BLOCKS]]
-    data = torch.tensor(data, dtype=torch.float).unsqueeze(0)
+    data = torch.tensor(data, dtype=torch.float, device=device).unsqueeze(0)
     return data
 
 
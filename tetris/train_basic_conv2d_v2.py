@@ -1,83 +1,162 @@
 from game import *
 from config import device
-from model_basic_conv2d import DQNBasicConv2d
+from model_basic_conv2d import DQNBasicConv2d, fold_batch_norm, autocast
 from memory import *
-import math
+from checkpoint import Checkpointer, snapshot_state_dict
+from telemetry import Telemetry, ProfileWindow, format_record
 import torch
 from torch import optim as optim
 from torch import nn as nn
-from itertools import count
+import copy
 import os
+import threading
 
 BATCH_SIZE = 2048
 GAMMA = 0.999
+N_STEPS = 3
 EPS_START = 0.9
 EPS_END = 0.05
 EPS_DECAY = 10000
 TARGET_UPDATE = 10
 SAVE_INTERVAL = 100
+CHECKPOINT_DIRECTORY = "checkpoints"
+KEEP_CHECKPOINTS = 3
+# Sample transitions in proportion to their TD error, with importance sampling weights, instead of uniformly.
+PRIORITIZED_REPLAY = False
+# Store transitions delta-encoded, rebuilding the input planes when sampling; replaces prioritized replay.
+DELTA_REPLAY = False
+# Set to a directory to keep the replay memory on disk across runs; it then replaces prioritized replay. Its
+# contents are not part of checkpoints, so resuming with it is not exact: transitions stored after the checkpoint
+# stay in the files.
+REPLAY_DIRECTORY = None
+REPLAY_CAPACITY = 10000
+# Games played in lockstep, their actions being chosen with one forward pass.
+PARALLEL_GAMES = 64
+MAX_ACTIONS_PER_GAME = 1000
+# GRADIENT_STEPS optimize_model calls are made for every ENV_STEPS_PER_UPDATE actions played, one per action by
+# default as when the games were played one at a time.
+GRADIENT_STEPS = 1
+ENV_STEPS_PER_UPDATE = 1
+# Batches sampled ahead on a background thread, 0 to sample in optimize_model.
+PREFETCH_BATCHES = 2
+# Per-phase timings and steps/sec are appended to TELEMETRY_FILEPATH as JSON lines every TELEMETRY_INTERVAL
+# seconds. Set PROFILE_ROUNDS to (first, last) to profile those rounds of train() with PROFILER, 'torch' or
+# 'cprofile'.
+TELEMETRY_FILEPATH = "metrics.jsonl"
+TELEMETRY_INTERVAL = 30
+PROFILE_ROUNDS = None
+PROFILER = 'torch'
+# Model execution, see model_basic_conv2d.benchmark for what each option gains here. COMPILE_MODEL runs the
+# networks through torch.compile, CHANNELS_LAST keeps them in channels_last memory format and BF16_AUTOCAST runs
+# their forward passes under bfloat16 autocast. FOLD_BATCH_NORM selects actions with a copy of policy_net whose
+# BatchNorm layers are folded into the convolutions, i.e. normalized with the running statistics instead of
+# those of the batch of games.
+COMPILE_MODEL = False
+CHANNELS_LAST = False
+BF16_AUTOCAST = False
+FOLD_BATCH_NORM = False
 
 POSSIBLE_ACTIONS = 4 * GAME_COLS
 
-policy_net = DQNBasicConv2d(GAME_ROWS, GAME_COLS, POSSIBLE_ACTIONS).to(device)
-target_net = DQNBasicConv2d(GAME_ROWS, GAME_COLS, POSSIBLE_ACTIONS).to(device)
+memory_format = torch.channels_last if CHANNELS_LAST else torch.contiguous_format
+policy_net = DQNBasicConv2d(GAME_ROWS, GAME_COLS, POSSIBLE_ACTIONS).to(device, memory_format=memory_format)
+target_net = DQNBasicConv2d(GAME_ROWS, GAME_COLS, POSSIBLE_ACTIONS).to(device, memory_format=memory_format)
 target_net.load_state_dict(policy_net.state_dict())
 target_net.eval()
+acting_net = fold_batch_norm(policy_net) if FOLD_BATCH_NORM else policy_net
+# The networks as called, sharing their parameters with the modules above which are the ones to save and load.
+policy_forward, target_forward, acting_forward = (torch.compile(net) if COMPILE_MODEL else net
+                                                  for net in (policy_net, target_net, acting_net))
 
 optimizer = optim.RMSprop(policy_net.parameters())
-memory = ReplayMemory(10000)
+criterion = nn.SmoothL1Loss(reduction='none')
+if REPLAY_DIRECTORY is not None:
+    memory = MemmapReplayMemory(REPLAY_DIRECTORY, REPLAY_CAPACITY, (2, GAME_ROWS, GAME_COLS), device,
+                                n_steps=N_STEPS, gamma=GAMMA)
+elif DELTA_REPLAY:
+    memory = DeltaReplayMemory(REPLAY_CAPACITY, GAME_ROWS, GAME_COLS, device, n_steps=N_STEPS, gamma=GAMMA)
+elif PRIORITIZED_REPLAY:
+    memory = PrioritizedReplayMemory(REPLAY_CAPACITY, (2, GAME_ROWS, GAME_COLS), device, n_steps=N_STEPS,
+                                     gamma=GAMMA)
+else:
+    memory = ArrayReplayMemory(REPLAY_CAPACITY, (2, GAME_ROWS, GAME_COLS), device, n_steps=N_STEPS, gamma=GAMMA)
 
 selections_done = 0
+telemetry = Telemetry(TELEMETRY_FILEPATH, TELEMETRY_INTERVAL)
 
 
-def select_action(state):
+def select_actions(inputs):
+    # Epsilon-greedy actions for a batch of inputs, epsilon decaying with every selection.
     global selections_done
 
-    eps_threshold = EPS_END + (EPS_START - EPS_END) * math.exp(-1. * selections_done / EPS_DECAY)
-    selections_done += 1
-    if random.random() > eps_threshold:
-        with torch.no_grad():
-            return policy_net(state).max(1)[1].view(1, 1)
-    else:
-        return torch.tensor([[random.randrange(GAME_ACTIONS)]], device=device, dtype=torch.int)
+    n = len(inputs)
+    eps_thresholds = EPS_END + (EPS_START - EPS_END) * np.exp(-1. * (selections_done + np.arange(n)) / EPS_DECAY)
+    selections_done += n
+    if FOLD_BATCH_NORM:
+        fold_batch_norm(policy_net, acting_net)
+    with torch.no_grad(), autocast(BF16_AUTOCAST):
+        actions = acting_forward(inputs).argmax(1).cpu().numpy()
+    explore = np.random.random(n) < eps_thresholds
+    actions[explore] = np.random.randint(POSSIBLE_ACTIONS, size=explore.sum())
+    return actions
 
 
-def optimize_model():
-    if len(memory) < BATCH_SIZE:
-        return
-    transitions = memory.sample(BATCH_SIZE)
+def select_action(state):
+    return torch.tensor([[select_actions(state)[0]]], device=device, dtype=torch.long)
 
-    batch = Transition(*zip(*transitions))
 
-    non_final_mask = torch.tensor(tuple(map(lambda s: s is not None,
-                                            batch.next_state)), device=device, dtype=torch.bool)
-    non_final_next_states = torch.cat([s for s in batch.next_state
-                                       if s is not None])
-    state_batch = torch.cat(batch.state)
-    action_batch = torch.cat(batch.action)
-    reward_batch = torch.cat(batch.reward)
+def optimize_model(batch: TransitionBatch = None, memory_lock=None):
+    # Samples the batch itself unless one is given, e.g. by a BatchPrefetcher sharing memory_lock.
+    if batch is None:
+        if len(memory) < BATCH_SIZE:
+            return
+        batch = memory.sample(BATCH_SIZE)
+        telemetry.lap('sample')
 
-    state_action_values = policy_net(state_batch).gather(1, action_batch)
+    with autocast(BF16_AUTOCAST):
+        state_action_values = policy_forward(batch.states).float().gather(1, batch.actions.unsqueeze(1))
+        next_state_values = target_forward(batch.next_states).float().max(1)[0].detach().masked_fill(batch.dones, 0)
 
-    next_state_values = torch.zeros(BATCH_SIZE, device=device)
-    next_state_values[non_final_mask] = target_net(non_final_next_states).max(1)[0].detach()
+    expected_state_action_values = (next_state_values * batch.discounts) + batch.rewards
 
-    expected_state_action_values = (next_state_values * GAMMA) + reward_batch
+    losses = criterion(state_action_values, expected_state_action_values.unsqueeze(1)).squeeze(1)
+    if batch.weights is not None:
+        losses = losses * batch.weights
+    loss = losses.mean()
+    telemetry.lap('forward')
 
-    criterion = nn.SmoothL1Loss()
-    loss = criterion(state_action_values, expected_state_action_values.unsqueeze(1))
+    td_errors = expected_state_action_values - state_action_values.detach().squeeze(1)
+    if memory_lock is None:
+        memory.update_priorities(batch.indices, td_errors.cpu().numpy())
+    else:
+        with memory_lock:
+            memory.update_priorities(batch.indices, td_errors.cpu().numpy())
+    telemetry.lap('update_priorities')
 
     optimizer.zero_grad()
     loss.backward()
+    telemetry.lap('backward')
     for param in policy_net.parameters():
         param.grad.data.clamp_(-1, 1)
     optimizer.step()
+    telemetry.lap('optimizer_step')
+    telemetry.count('learner_steps')
+    telemetry.count('samples', len(batch.actions))
+
+
+def get_planes(state: GameState):
+    return state.data[[GameState.DATA_INDEX_FROZEN_BLOCKS, GameState.DATA_INDEX_FALLING_BLOCKS]]
 
 
-def get_input(state: GameState):
-    data = state.data[[GameState.DATA_INDEX_FROZEN_BLOCKS, GameState.DATA_INDEX_FALLING_BLOCKS]]
-    data = torch.tensor(data, dtype=torch.float).unsqueeze(0)
-    return data
+def get_input(state: GameState, planes=None):
+    if planes is None:
+        planes = get_planes(state)
+    return torch.tensor(planes, dtype=torch.float, device=device).unsqueeze(0)
+
+
+def get_inputs(planes: np.ndarray):
+    # Batched get_input over planes stacked along the first axis.
+    return torch.from_numpy(planes).to(device).float()
 
 
 def get_reward(state: GameState):
@@ -90,7 +169,16 @@ def get_reward(state: GameState):
 
 
 def perform_action(state: GameState, action_code):
-    rotation_times = torch.div(action_code, GAME_COLS, rounding_mode='trunc')
+    action_code = int(action_code)
+    rotation = state.falling_piece_rotation + action_code // GAME_COLS
+    if not place_piece(state, rotation, action_code % GAME_COLS - 1):
+        # The placement is blocked at the current row, play the key presses to get as far as they go.
+        perform_action_key_presses(state, action_code)
+    return state
+
+
+def perform_action_key_presses(state: GameState, action_code):
+    rotation_times = action_code // GAME_COLS
     while rotation_times > 0:
         user_rotate_piece(state)
         rotation_times -= 1
@@ -124,64 +212,216 @@ def _test_perform_action():
             print(i, s.blocks[15:])
 
 
-def train():
-    model_weight_filepath = "weights/{}.II.pth".format(type(target_net).__name__)
+def new_training_game():
+    # Seeded from np.random, which checkpoints save, so that a resumed run plays the same pieces.
+    return new_game(seed=np.random.randint(2 ** 63))
 
-    if os.path.exists(model_weight_filepath):
-        policy_net.load_state_dict(torch.load(model_weight_filepath))
-        target_net.load_state_dict(policy_net.state_dict())
-        target_net.eval()
 
-    episode_count = 5000
-    episode_durations = []
-    episode_scores = []
+def get_training_state(loop_state):
+    # Copy of everything a run needs to resume: networks, optimizer, epsilon schedule, replay memory, RNGs and
+    # the loop state of train(), including the games in progress.
+    return {
+        'policy_net': snapshot_state_dict(policy_net.state_dict()),
+        'target_net': snapshot_state_dict(target_net.state_dict()),
+        'optimizer': copy.deepcopy(optimizer.state_dict()),
+        'selections_done': selections_done,
+        'memory': memory.state_dict(),
+        'random': random.getstate(),
+        'numpy_random': np.random.get_state(),
+        'torch_random': torch.get_rng_state(),
+        'loop': copy.deepcopy(loop_state),
+    }
+
+
+def load_training_state(state):
+    global selections_done
 
-    for episode in range(episode_count):
-        game_state = new_game()
-        for actions_done in count():
-            model_state = get_input(game_state)
+    policy_net.load_state_dict(state['policy_net'])
+    target_net.load_state_dict(state['target_net'])
+    optimizer.load_state_dict(state['optimizer'])
+    selections_done = state['selections_done']
+    memory.load_state_dict(state['memory'])
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy_random'])
+    torch.set_rng_state(state['torch_random'])
+    return state['loop']
+
+
+def train(episode_count=5000):
+    model_weight_filepath = "weights/{}.II.pth".format(type(target_net).__name__)
+    checkpointer = Checkpointer(CHECKPOINT_DIRECTORY, KEEP_CHECKPOINTS)
+
+    loop_state = {
+        'episode': 0,
+        'episode_durations': [],
+        'episode_scores': [],
+        'game_states': [new_training_game() for _ in range(PARALLEL_GAMES)],
+        'actions_done': [0] * PARALLEL_GAMES,
+        'updates_due': 0.0,
+    }
+
+    checkpoint = checkpointer.load_latest(map_location=device)
+    if checkpoint is not None:
+        loop_state = load_training_state(checkpoint)
+        print('resuming from episode', loop_state['episode'])
+    elif os.path.exists(model_weight_filepath):
+        policy_net.load_state_dict(torch.load(model_weight_filepath))
+        target_net.load_state_dict(policy_net.state_dict())
+    target_net.eval()
+
+    episode_durations = loop_state['episode_durations']
+    episode_scores = loop_state['episode_scores']
+    game_states = loop_state['game_states']
+    actions_done = loop_state['actions_done']
+
+    memory_lock = threading.Lock()
+    prefetcher = None
+    if PREFETCH_BATCHES > 0:
+        prefetcher = BatchPrefetcher(memory, BATCH_SIZE, PREFETCH_BATCHES, memory_lock, telemetry)
+    profile_window = ProfileWindow(*PROFILE_ROUNDS, PROFILER) if PROFILE_ROUNDS is not None else None
+    rounds = 0
+    telemetry.lap('setup')
+
+    while loop_state['episode'] < episode_count:
+        if profile_window is not None:
+            profile_window.update(rounds)
+        rounds += 1
+
+        planes = np.stack([get_planes(game_state) for game_state in game_states])
+        inputs = get_inputs(planes)
+        telemetry.lap('get_input')
+        action_codes = select_actions(inputs)
+        telemetry.lap('select_actions')
+        save_due = False
+
+        for i, (game_state, action_code) in enumerate(zip(game_states, action_codes.tolist())):
+            state_key = encode_game_state(game_state)
             initial_score = game_state.score
 
-            action_code = select_action(model_state)
             perform_action(game_state, action_code)
+            placement = (game_state.falling_piece_rotation,) + tuple(game_state.falling_piece_location)
+            telemetry.lap('perform_action')
             step(game_state)
+            telemetry.lap('step')
+            telemetry.count('env_steps')
+            actions_done[i] += 1
 
             reward = game_state.score - initial_score
-            reward = torch.tensor([reward], device=device)
 
             game_over = game_state.status != GameStatus.RUNNING
 
-            next_model_state = get_input(game_state)
-            if game_over:
-                next_model_state = None
-
-            memory.push(model_state, action_code, next_model_state, reward)
-
-            optimize_model()
-            if game_over or actions_done > 1000:
-                episode_durations.append(actions_done + 1)
-                episode_scores.append(game_state.score)
-                break
-
-        if episode % TARGET_UPDATE == 0:
-            print('==== episode {} ===='.format(episode))
-            print(
-                'selections_done', selections_done,
-                'max_score', np.max(episode_scores),
-                'mean_score', np.mean(episode_scores[-10:]),
-                'mean_duration', np.mean(episode_durations[-10:]),
-                sep='\t'
-            )
-            print(game_state)
-            print(game_state.blocks)
-            target_net.load_state_dict(policy_net.state_dict())
-
-        if episode % SAVE_INTERVAL == 0:
-            torch.save(target_net.state_dict(), model_weight_filepath)
-
+            with memory_lock:
+                if isinstance(memory, DeltaReplayMemory):
+                    memory.push(state_key, action_code, placement, reward, game_over, env=i)
+                else:
+                    next_planes = None if game_over else get_planes(game_state)
+                    memory.push(planes[i], action_code, next_planes, reward, env=i)
+            telemetry.lap('memory_push')
+
+            if not game_over and actions_done[i] <= MAX_ACTIONS_PER_GAME:
+                continue
+
+            # The game is over, replace it in place.
+            with memory_lock:
+                memory.end_episode(i)
+            episode_durations.append(actions_done[i])
+            episode_scores.append(game_state.score)
+            game_states[i] = new_training_game()
+            actions_done[i] = 0
+
+            episode = loop_state['episode']
+            if episode % TARGET_UPDATE == 0:
+                print('==== episode {} ===='.format(episode))
+                print(
+                    'selections_done', selections_done,
+                    'max_score', np.max(episode_scores),
+                    'mean_score', np.mean(episode_scores[-10:]),
+                    'mean_duration', np.mean(episode_durations[-10:]),
+                    sep='\t'
+                )
+                print(game_state)
+                print(game_state.blocks)
+                target_net.load_state_dict(policy_net.state_dict())
+
+            if episode % SAVE_INTERVAL == 0:
+                save_due = True
+            loop_state['episode'] += 1
+            telemetry.count('episodes')
+            telemetry.lap('bookkeeping')
+
+        loop_state['updates_due'] += GRADIENT_STEPS * len(game_states) / ENV_STEPS_PER_UPDATE
+        if len(memory) < BATCH_SIZE:
+            loop_state['updates_due'] = 0.0
+        while loop_state['updates_due'] >= 1:
+            loop_state['updates_due'] -= 1
+            if prefetcher is None:
+                optimize_model()
+            else:
+                batch = prefetcher.get()
+                telemetry.lap('prefetch_wait')
+                optimize_model(batch, memory_lock)
+
+        # Checkpoints are taken between rounds, where the loop state is complete.
+        if save_due:
+            with memory_lock:
+                training_state = get_training_state(loop_state)
+            checkpointer.save(loop_state['episode'], training_state,
+                              [(snapshot_state_dict(target_net.state_dict()), model_weight_filepath)])
+            telemetry.lap('checkpoint')
+
+        if telemetry.report_due():
+            record = telemetry.report(episode=loop_state['episode'], selections_done=selections_done,
+                                      replay_size=len(memory))
+            print(format_record(record))
+            telemetry.lap('telemetry')
+
+    if profile_window is not None:
+        profile_window.stop()
+    if prefetcher is not None:
+        prefetcher.close()
+    print(format_record(telemetry.report(episode=loop_state['episode'], selections_done=selections_done,
+                                         replay_size=len(memory))))
     print('completing...')
     print('durations', episode_durations)
-    torch.save(target_net.state_dict(), model_weight_filepath)
+    with memory_lock:
+        training_state = get_training_state(loop_state)
+    checkpointer.save(loop_state['episode'], training_state,
+                      [(snapshot_state_dict(target_net.state_dict()), model_weight_filepath)])
+    checkpointer.close()
+
+
+def evaluate(episode_count=100, games=PARALLEL_GAMES, net=policy_net):
+    # Plays episode_count games greedily, `games` at a time in lockstep, and returns their scores.
+    training = net.training
+    net.eval()
+    game_states = [new_game() for _ in range(min(games, episode_count))]
+    actions_done = [0] * len(game_states)
+    started = len(game_states)
+    scores = []
+    while game_states:
+        planes = np.stack([get_planes(game_state) for game_state in game_states])
+        with torch.no_grad():
+            action_codes = net(get_inputs(planes)).argmax(1).tolist()
+
+        for i, (game_state, action_code) in enumerate(zip(game_states, action_codes)):
+            perform_action(game_state, action_code)
+            step(game_state)
+            actions_done[i] += 1
+            if game_state.status == GameStatus.RUNNING and actions_done[i] <= MAX_ACTIONS_PER_GAME:
+                continue
+            scores.append(game_state.score)
+            if started < episode_count:
+                game_states[i] = new_game()
+                actions_done[i] = 0
+                started += 1
+            else:
+                game_states[i] = None
+        actions_done = [n for game_state, n in zip(game_states, actions_done) if game_state is not None]
+        game_states = [game_state for game_state in game_states if game_state is not None]
+
+    net.train(training)
+    print('episodes', len(scores), 'max_score', np.max(scores), 'mean_score', np.mean(scores), sep='\t')
+    return scores
 
 
 if __name__ == "__main__":
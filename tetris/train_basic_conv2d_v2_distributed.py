@@ -0,0 +1,142 @@
+import time
+import torch
+import torch.multiprocessing as mp
+import train_basic_conv2d_v2 as trainer
+from train_basic_conv2d_v2 import *
+
+# Actor/learner mode of train_basic_conv2d_v2: ACTORS processes play games with their own fixed epsilon and
+# push into a SharedReplayMemory, one learner process runs optimize_model on it and broadcasts the policy
+# weights through a model in shared memory every WEIGHT_BROADCAST_INTERVAL gradient steps. The main process
+# reports the throughput of every role.
+ACTORS = 4
+ACTOR_EPS_BASE = 0.4
+ACTOR_EPS_ALPHA = 7
+ACTOR_MAX_ACTIONS = 1000
+WEIGHT_BROADCAST_INTERVAL = 50
+TARGET_UPDATE_STEPS = 1000
+LEARNER_SAVE_INTERVAL = 1000
+REPORT_INTERVAL = 10
+
+
+def actor_epsilon(index, actors):
+    # Actor i explores with ACTOR_EPS_BASE ^ (1 + ACTOR_EPS_ALPHA * i / (actors - 1)), from 0.4 down to ~0.0007.
+    exponent = 1 + ACTOR_EPS_ALPHA * index / (actors - 1) if actors > 1 else 1
+    return ACTOR_EPS_BASE ** exponent
+
+
+def run_actor(index, epsilon, memory, shared_net, weights_lock, weights_version, actor_steps, stop_event):
+    torch.set_num_threads(1)
+    rng = np.random.default_rng()
+    policy = DQNBasicConv2d(GAME_ROWS, GAME_COLS, POSSIBLE_ACTIONS).to(device)
+    policy.eval()
+    version = -1
+
+    game_state = new_game()
+    actions_done = 0
+    while not stop_event.is_set():
+        if weights_version.value != version:
+            with weights_lock:
+                version = weights_version.value
+                policy.load_state_dict(shared_net.state_dict())
+
+        planes = get_planes(game_state)
+        if rng.random() < epsilon:
+            action_code = int(rng.integers(POSSIBLE_ACTIONS))
+        else:
+            with torch.no_grad():
+                action_code = int(policy(get_input(game_state, planes)).argmax(1))
+
+        initial_score = game_state.score
+        perform_action(game_state, action_code)
+        step(game_state)
+        game_over = game_state.status != GameStatus.RUNNING
+        next_planes = None if game_over else get_planes(game_state)
+        memory.push(planes, action_code, next_planes, game_state.score - initial_score)
+
+        actions_done += 1
+        actor_steps[index] += 1
+        if game_over or actions_done > ACTOR_MAX_ACTIONS:
+            memory.end_episode()
+            game_state = new_game()
+            actions_done = 0
+
+
+def run_learner(memory, shared_net, weights_lock, weights_version, learner_steps, stop_event, model_weight_filepath):
+    # optimize_model works on the module globals of the trainer, which are this process' own. They start from the
+    # weights train() loaded into shared_net.
+    trainer.memory = memory
+    trainer.policy_net.load_state_dict(shared_net.state_dict())
+    trainer.target_net.load_state_dict(shared_net.state_dict())
+    while not stop_event.is_set():
+        if len(memory) < trainer.BATCH_SIZE:
+            time.sleep(0.1)
+            continue
+        trainer.optimize_model()
+        learner_steps.value += 1
+
+        if learner_steps.value % WEIGHT_BROADCAST_INTERVAL == 0:
+            with weights_lock:
+                shared_net.load_state_dict(trainer.policy_net.state_dict())
+                weights_version.value += 1
+        if learner_steps.value % TARGET_UPDATE_STEPS == 0:
+            trainer.target_net.load_state_dict(trainer.policy_net.state_dict())
+        if learner_steps.value % LEARNER_SAVE_INTERVAL == 0:
+            torch.save(trainer.policy_net.state_dict(), model_weight_filepath)
+
+    torch.save(trainer.policy_net.state_dict(), model_weight_filepath)
+
+
+def train(actors=ACTORS, duration=None):
+    model_weight_filepath = "weights/{}.II.pth".format(type(target_net).__name__)
+    context = mp.get_context('spawn')
+
+    shared_net = DQNBasicConv2d(GAME_ROWS, GAME_COLS, POSSIBLE_ACTIONS)
+    if os.path.exists(model_weight_filepath):
+        shared_net.load_state_dict(torch.load(model_weight_filepath))
+    shared_net.share_memory()
+    replay = SharedReplayMemory(REPLAY_CAPACITY, (2, GAME_ROWS, GAME_COLS), device, n_steps=N_STEPS, gamma=GAMMA,
+                                lock=context.Lock())
+    weights_lock = context.Lock()
+    weights_version = context.Value('q', 0)
+    actor_steps = context.Array('q', actors)
+    learner_steps = context.Value('q', 0)
+    stop_event = context.Event()
+
+    processes = [context.Process(target=run_learner, args=(replay, shared_net, weights_lock, weights_version,
+                                                           learner_steps, stop_event, model_weight_filepath))]
+    for index in range(actors):
+        processes.append(context.Process(target=run_actor, args=(
+            index, actor_epsilon(index, actors), replay, shared_net, weights_lock, weights_version, actor_steps,
+            stop_event)))
+    for process in processes:
+        process.start()
+
+    start = last_report = time.time()
+    last_actor_steps = [0] * actors
+    last_learner_steps = 0
+    try:
+        while duration is None or time.time() - start < duration:
+            time.sleep(min(REPORT_INTERVAL, duration) if duration is not None else REPORT_INTERVAL)
+            now = time.time()
+            elapsed = now - last_report
+            steps = list(actor_steps)
+            actor_rates = [(new - old) / elapsed for new, old in zip(steps, last_actor_steps)]
+            learner_rate = (learner_steps.value - last_learner_steps) / elapsed
+            print('==== {:.0f}s ===='.format(now - start))
+            print('actors', 'steps/sec {:.1f}'.format(sum(actor_rates)),
+                  'per actor', ' '.join('{:.1f}'.format(rate) for rate in actor_rates), sep='\t')
+            print('learner', 'steps/sec {:.2f}'.format(learner_rate),
+                  'samples/sec {:.0f}'.format(learner_rate * trainer.BATCH_SIZE),
+                  'weights_version', weights_version.value, 'replay_size', len(replay), sep='\t')
+            last_report, last_actor_steps, last_learner_steps = now, steps, learner_steps.value
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        for process in processes:
+            process.join()
+        replay.unlink()
+
+
+if __name__ == "__main__":
+    train()
@@ -0,0 +1,159 @@
+import time
+import numpy as np
+from game import *
+
+
+# N games stepped together, every operation being a whole-array NumPy operation.
+#
+# Boards are stored as a single (N, 4, rows, columns) array using the plane layout of GameState.
+# Actions are the macro actions of train_basic_conv2d_v2: action // columns rotations, then moving the
+# piece so that its shape box starts at column action % columns - 1 (clamped to the walls), then a hard
+# drop onto the skyline. A placement that cannot be reached from above tops the game out. `step` locks
+# the dropped pieces, clears lines and spawns the next pieces; games that end are reset in place.
+class VecGame:
+    def __init__(self, n, rows=GAME_ROWS, columns=GAME_COLS, seed=None, piece_generator_mode='uniform'):
+        self.n = n
+        self.rows = rows
+        self.columns = columns
+        self.piece_generator = PieceGenerator(seed, piece_generator_mode)
+        self.data = np.zeros((n, 4, rows, columns), dtype=np.uint8)
+        self.piece_ids = np.zeros(n, dtype=int)
+        self.rotations = np.zeros(n, dtype=int)
+        self.locations = np.zeros((n, 2), dtype=int)
+        self.next_piece_ids = np.zeros(n, dtype=int)
+        self.next_rotations = np.zeros(n, dtype=int)
+        self.scores = np.zeros(n, dtype=int)
+        self.lines_cleared = np.zeros(n, dtype=int)
+        self.final_scores = np.zeros(n, dtype=int)
+        self.reward_scores = np.zeros(n, dtype=int)
+        self.topped_out = np.zeros(n, dtype=bool)
+        self.reset()
+
+    @property
+    def frozen_blocks(self):
+        return self.data[:, GameState.DATA_INDEX_FROZEN_BLOCKS]
+
+    @property
+    def falling_blocks(self):
+        return self.data[:, GameState.DATA_INDEX_FALLING_BLOCKS]
+
+    def numpy(self):
+        return self.data[:, [GameState.DATA_INDEX_FROZEN_BLOCKS, GameState.DATA_INDEX_FALLING_BLOCKS]]
+
+    def reset(self, mask=None):
+        index = np.arange(self.n) if mask is None else np.flatnonzero(mask)
+        if len(index) == 0:
+            return
+        self.data[index] = 0
+        self.scores[index] = 0
+        self.lines_cleared[index] = 0
+        self.reward_scores[index] = 0
+        self.topped_out[index] = False
+        self._generate_next_pieces(index)
+        self._stage_next_pieces(index)
+        self._generate_next_pieces(index)
+        self._update_falling_blocks(index)
+
+    def perform_actions(self, actions):
+        actions = np.asarray(actions)
+        ids = self.piece_ids
+        rotations = (self.rotations + actions // self.columns) % PIECE_ROTATION_COUNTS[ids]
+        column_ranges = PIECE_COLUMN_RANGES[ids, rotations]
+        columns = np.clip(actions % self.columns - 1, column_ranges[:, 0], column_ranges[:, 1])
+
+        landing_rows = self._landing_rows(ids, rotations, columns)
+        drop_distances = np.maximum(landing_rows - self.locations[:, 0], 0)
+        self.topped_out = (landing_rows + PIECE_ROW_RANGES[ids, rotations, 0] < 0) | \
+                          (landing_rows < self.locations[:, 0])
+
+        self.rotations = rotations
+        self.locations[:, 0] = np.maximum(landing_rows, self.locations[:, 0])
+        self.locations[:, 1] = columns
+        self.scores += drop_distances * 2
+        self._update_falling_blocks(np.arange(self.n))
+
+    # Locks resting pieces, lets the others fall one row and returns (rewards, game_over) per game.
+    # Rewards are the score gained since the previous call. Games that end here are reset before
+    # returning, `final_scores` keeps the score they ended with.
+    def step(self):
+        landing_rows = self._landing_rows(self.piece_ids, self.rotations, self.locations[:, 1])
+        resting = landing_rows <= self.locations[:, 0]
+        self.locations[~resting, 0] += 1
+
+        game_over = self.topped_out.copy()
+        lock = np.flatnonzero(resting & ~game_over)
+        if len(lock) > 0:
+            self._froze_falling_pieces(lock)
+            self._remove_complete_lines(lock)
+            game_over[lock] |= ~self._stage_next_pieces(lock)
+            self._generate_next_pieces(lock)
+
+        rewards = self.scores - self.reward_scores
+        self.reward_scores[:] = self.scores
+        self.final_scores[game_over] = self.scores[game_over]
+        self._update_falling_blocks(np.flatnonzero(~game_over))
+        self.reset(game_over)
+        return rewards, game_over
+
+    def _landing_rows(self, ids, rotations, columns):
+        return compute_landing_rows(compute_column_heights(self.frozen_blocks), self.rows, ids, rotations, columns)
+
+    def _generate_next_pieces(self, index):
+        self.next_piece_ids[index], self.next_rotations[index] = self.piece_generator.take(len(index))
+
+    def _stage_next_pieces(self, index):
+        ids = self.next_piece_ids[index]
+        rotations = self.next_rotations[index]
+        stage_rows = compute_stage_rows(self.frozen_blocks[index], ids, rotations)
+        stage_ok = stage_rows < self.rows
+
+        self.piece_ids[index] = np.where(stage_ok, ids, 0)
+        self.rotations[index] = rotations
+        self.locations[index, 0] = np.where(stage_ok, stage_rows, 0)
+        self.locations[index, 1] = SPAWN_COL
+        return stage_ok
+
+    def _froze_falling_pieces(self, index):
+        ids = self.piece_ids[index]
+        cell_rows, cell_cols = compute_piece_cells(ids, self.rotations[index],
+                                           self.locations[index, 0], self.locations[index, 1])
+        self.data[index[:, None], GameState.DATA_INDEX_FROZEN_BLOCKS, cell_rows, cell_cols] = 1
+        self.data[index[:, None], GameState.DATA_INDEX_FROZEN_BLOCKS_COLOR_CODE, cell_rows, cell_cols] = \
+            PIECE_COLORS[ids][:, None]
+
+    def _remove_complete_lines(self, index):
+        complete = self.frozen_blocks[index].all(axis=2)
+        removed_lines_count = complete.sum(axis=1)
+        self.scores[index] += REMOVED_LINES_SCORES[removed_lines_count]
+        self.lines_cleared[index] += removed_lines_count
+
+        clearing = index[removed_lines_count > 0]
+        if len(clearing) > 0:
+            frozen_planes = self.data[clearing, :GameState.DATA_INDEX_FALLING_BLOCKS]
+            self.data[clearing, :GameState.DATA_INDEX_FALLING_BLOCKS] = \
+                compact_complete_rows(frozen_planes, complete[removed_lines_count > 0])
+
+    def _update_falling_blocks(self, index):
+        self.data[index, GameState.DATA_INDEX_FALLING_BLOCKS:] = 0
+        index = index[(self.piece_ids[index] != 0) & ~self.topped_out[index]]
+        ids = self.piece_ids[index]
+        cell_rows, cell_cols = compute_piece_cells(ids, self.rotations[index],
+                                           self.locations[index, 0], self.locations[index, 1])
+        self.data[index[:, None], GameState.DATA_INDEX_FALLING_BLOCKS, cell_rows, cell_cols] = 1
+        self.data[index[:, None], GameState.DATA_INDEX_FALLING_BLOCKS_COLOR_CODE, cell_rows, cell_cols] = \
+            PIECE_COLORS[ids][:, None]
+
+
+def benchmark_vec_game(n=1024, rounds=200):
+    games = VecGame(n, seed=0)
+    rng = np.random.default_rng(0)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        games.perform_actions(rng.integers(0, 4 * GAME_COLS, size=n))
+        games.step()
+    elapsed = time.perf_counter() - start
+    print('{} games x {} rounds: {:.0f} placements/sec'.format(n, rounds, n * rounds / elapsed))
+
+
+if __name__ == "__main__":
+    benchmark_vec_game()
@@ -0,0 +1,101 @@
+from collections import OrderedDict
+import numpy as np
+from game_piece import *
+
+# Zobrist keys: a board hashes to the XOR of the keys of its filled cells, and a game state additionally
+# mixes in keys for the falling piece, its location and the next piece. The keys are fixed by ZOBRIST_SEED
+# so that hashes agree across processes and runs.
+ZOBRIST_SEED = 20211029
+
+_rng = np.random.default_rng(ZOBRIST_SEED)
+ZOBRIST_CELL_KEYS = _rng.integers(np.iinfo(np.uint64).max, size=(GAME_ROWS, GAME_COLS), dtype=np.uint64)
+ZOBRIST_FALLING_PIECE_KEYS = _rng.integers(np.iinfo(np.uint64).max, size=(len(PIECES_BY_ID), MAX_ROTATIONS),
+                                           dtype=np.uint64)
+ZOBRIST_NEXT_PIECE_KEYS = _rng.integers(np.iinfo(np.uint64).max, size=(len(PIECES_BY_ID), MAX_ROTATIONS),
+                                        dtype=np.uint64)
+# Locations are offset by SHAPE_BOX_SIZE, pieces can start above the board and stick out of its left side.
+ZOBRIST_ROW_KEYS = _rng.integers(np.iinfo(np.uint64).max, size=GAME_ROWS + SHAPE_BOX_SIZE, dtype=np.uint64)
+ZOBRIST_COL_KEYS = _rng.integers(np.iinfo(np.uint64).max, size=GAME_COLS + SHAPE_BOX_SIZE, dtype=np.uint64)
+
+# Plain int copies for the incremental updates done one cell at a time by the engine.
+CELL_KEYS = ZOBRIST_CELL_KEYS.tolist()
+FALLING_PIECE_KEYS = ZOBRIST_FALLING_PIECE_KEYS.tolist()
+NEXT_PIECE_KEYS = ZOBRIST_NEXT_PIECE_KEYS.tolist()
+ROW_KEYS = ZOBRIST_ROW_KEYS.tolist()
+COL_KEYS = ZOBRIST_COL_KEYS.tolist()
+
+
+def hash_boards(boards: np.ndarray) -> np.ndarray:
+    # Hashes of a single (rows, columns) board or a stack of them.
+    rows, columns = boards.shape[-2:]
+    keys = np.where(boards != 0, ZOBRIST_CELL_KEYS[:rows, :columns], np.uint64(0))
+    return np.bitwise_xor.reduce(keys.reshape(boards.shape[:-2] + (-1,)), axis=-1)
+
+
+def hash_board(board: np.ndarray) -> int:
+    return int(hash_boards(board))
+
+
+def hash_pieces(falling_piece_id, falling_piece_rotation, location, next_piece_id, next_piece_rotation) -> int:
+    row, col = location
+    return (FALLING_PIECE_KEYS[falling_piece_id][falling_piece_rotation]
+            ^ ROW_KEYS[row + SHAPE_BOX_SIZE] ^ COL_KEYS[col + SHAPE_BOX_SIZE]
+            ^ NEXT_PIECE_KEYS[next_piece_id][next_piece_rotation])
+
+
+class TranspositionCache:
+    # Bounded LRU cache keyed by Zobrist hashes (or tuples built from them), for network outputs and search
+    # values of positions that have already been evaluated.
+    def __init__(self, capacity=1 << 16):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def get(self, key, default=None):
+        value = self.entries.get(key, default)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def evaluate(self, keys, inputs, evaluate_batch):
+        # Looks every key up and runs evaluate_batch once, on the inputs of the distinct missing keys only.
+        # inputs and the value returned by evaluate_batch are indexed along their first axis, the result is a
+        # list of values aligned with keys.
+        values = [self.get(key) for key in keys]
+        missing = {}
+        for i, (key, value) in enumerate(zip(keys, values)):
+            if value is None:
+                missing.setdefault(key, []).append(i)
+        if missing:
+            evaluated = evaluate_batch(inputs[[indices[0] for indices in missing.values()]])
+            for (key, indices), value in zip(missing.items(), evaluated):
+                self.put(key, value)
+                for i in indices:
+                    values[i] = value
+        return values
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0